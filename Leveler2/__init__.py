@@ -4,4 +4,5 @@ from .leveler import Leveler
 async def setup(bot):
     n = Leveler(bot)
     bot.add_listener(n.listener, "on_message")
+    bot.add_listener(n.command_listener, "on_command_completion")
     await bot.add_cog(n)
@@ -0,0 +1,227 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from io import BytesIO
+from math import ceil
+
+from PIL import Image
+
+from .cache import LRUCache
+
+CARD_SIZE = (340, 390)
+
+# Limits on downloaded backgrounds. JPEG gets a higher pixel limit since
+# only a reduced version of it is ever decoded (see decode_background).
+MAX_BYTES = 8 * 1024 * 1024
+MAX_PIXELS = 16 * 1000 * 1000
+MAX_JPEG_PIXELS = 64 * 1000 * 1000
+
+
+class BackgroundError(Exception):
+    """Raised when a background is too big to be downloaded or decoded."""
+
+
+def image_size(im):
+    return im.size[0] * im.size[1] * len(im.getbands())
+
+
+def decode_background(data):
+    """Decode `data` with no more pixels than the card needs.
+
+    Only the first frame of animated images is decoded."""
+    im = Image.open(BytesIO(data))
+    width, height = im.size
+    limit = MAX_JPEG_PIXELS if im.format == "JPEG" else MAX_PIXELS
+    if width * height > limit:
+        raise BackgroundError(f"{width}x{height} image is too large")
+    # same cover scaling as prepare_background
+    scale = max(CARD_SIZE[0] / width, CARD_SIZE[1] / height)
+    if scale >= 1:
+        im.load()
+        return im
+    if im.format == "JPEG":
+        # let libjpeg decode at 1/2, 1/4 or 1/8 scale, never below the needed size
+        im.draft(im.mode, (ceil(width * scale), ceil(height * scale)))
+        im.load()
+        return im
+    im.load()
+    factor = int(1 / scale)
+    if factor >= 2:
+        im = im.reduce(factor)
+    return im
+
+
+def prepare_background(bg):
+    """Scale and crop `bg` to the card size, with the 50% alpha applied.
+
+    Areas of the card the background does not cover are left transparent."""
+    width, height = CARD_SIZE
+    bg_width, bg_height = bg.size
+    ratio = bg_height / height
+    bg = bg.resize((int(bg_width / (ratio)), int(bg_height / ratio)))
+    if bg.size[0] < width:
+        ratio = bg_width / width
+        bg = bg.resize((int(bg_width / (ratio)), int(bg_height / ratio)))
+    bg = bg.convert("RGBA")
+    bg.putalpha(128)
+    offset = (0, 0)
+    if bg.size[0] >= width:
+        offset = (int((-(bg.size[0] - width) / 2)), 0)
+    if bg.size[0] < width:
+        offset = (0, int((-(bg.size[1] - height) / 2)))
+    layer = Image.new("RGBA", CARD_SIZE, (0, 0, 0, 0))
+    layer.paste(bg, offset)
+    return layer
+
+
+class BackgroundCache:
+    """Profile backgrounds, prepared for the card and stored on disk.
+
+    Files are named after the digest of the downloaded content, so urls
+    serving the same image share one file. Urls are revalidated in the
+    background with conditional requests once `revalidate_after` seconds
+    have passed; the cached file keeps being served meanwhile. Least
+    recently used files are deleted once the folder exceeds `max_bytes`."""
+
+    def __init__(self, path, session, max_bytes=64 * 1024 * 1024, revalidate_after=86400):
+        self.path = path
+        self.session = session
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._index_path = self.path / "index.json"
+        try:
+            with open(self._index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        # {url: {"digest", "etag", "last_modified", "validated"}}
+        self._urls = index.get("urls", {})
+        # {digest: {"size", "used"}}
+        self._files = index.get("files", {})
+        self._memory = LRUCache(16 * 1024 * 1024, sizeof=image_size)
+        self._revalidating = {}
+
+    def digest(self, url):
+        """Digest of the content currently cached for `url`, None if unknown."""
+        entry = self._urls.get(url)
+        return entry["digest"] if entry else None
+
+    def _file(self, digest):
+        return self.path / f"{digest}.png"
+
+    def _save_index(self):
+        tmp = self._index_path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"urls": self._urls, "files": self._files}, f)
+        os.replace(tmp, self._index_path)
+
+    async def get(self, url):
+        entry = self._urls.get(url)
+        if entry is not None and entry["digest"] in self._files:
+            digest = entry["digest"]
+            self._files[digest]["used"] = time.time()
+            if (
+                time.time() - entry["validated"] > self.revalidate_after
+                and url not in self._revalidating
+            ):
+                task = asyncio.ensure_future(self._revalidate(url))
+                self._revalidating[url] = task
+                task.add_done_callback(lambda _: self._revalidating.pop(url, None))
+            image = self._memory.get(digest)
+            if image is None:
+                loop = asyncio.get_running_loop()
+                try:
+                    image = await loop.run_in_executor(None, self._load, digest)
+                except OSError:
+                    self._forget_file(digest)
+                    return await self._fetch(url)
+                self._memory.set(digest, image)
+            return image
+        return await self._fetch(url)
+
+    def _load(self, digest):
+        with Image.open(self._file(digest)) as im:
+            im.load()
+            return im
+
+    async def _revalidate(self, url):
+        try:
+            await self._fetch(url, conditional=True)
+        except Exception:
+            # keep serving the cached copy, try again on a later request
+            if url in self._urls:
+                self._urls[url]["validated"] = time.time()
+
+    async def _download(self, url, headers):
+        async with self.session.get(url, headers=headers) as r:
+            if r.status == 304:
+                return None, r.headers
+            r.raise_for_status()
+            if (r.content_length or 0) > MAX_BYTES:
+                raise BackgroundError(f"{url} is larger than {MAX_BYTES} bytes")
+            data = bytearray()
+            async for chunk in r.content.iter_chunked(64 * 1024):
+                data += chunk
+                if len(data) > MAX_BYTES:
+                    raise BackgroundError(f"{url} is larger than {MAX_BYTES} bytes")
+            return bytes(data), r.headers
+
+    async def _fetch(self, url, conditional=False):
+        entry = self._urls.get(url)
+        headers = {}
+        if conditional and entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        data, response_headers = await self._download(url, headers)
+        if data is None:
+            entry["validated"] = time.time()
+            self._save_index()
+            return None
+        digest = hashlib.sha256(data).hexdigest()
+        image = self._memory.get(digest)
+        if image is None or digest not in self._files:
+            loop = asyncio.get_running_loop()
+            image, size = await loop.run_in_executor(None, self._store, data, digest)
+            self._files[digest] = {"size": size, "used": time.time()}
+            self._memory.set(digest, image)
+        self._urls[url] = {
+            "digest": digest,
+            "etag": response_headers.get("ETag"),
+            "last_modified": response_headers.get("Last-Modified"),
+            "validated": time.time(),
+        }
+        self._evict()
+        self._save_index()
+        return image
+
+    def _store(self, data, digest):
+        with decode_background(data) as im:
+            image = prepare_background(im)
+        path = self._file(digest)
+        image.save(path, format="PNG")
+        return image, path.stat().st_size
+
+    def _forget_file(self, digest):
+        self._files.pop(digest, None)
+        self._memory.pop(digest)
+        for url in [u for u, e in self._urls.items() if e["digest"] == digest]:
+            del self._urls[url]
+        try:
+            os.remove(self._file(digest))
+        except OSError:
+            pass
+
+    def _evict(self):
+        total = sum(f["size"] for f in self._files.values())
+        if total <= self.max_bytes:
+            return
+        for digest in sorted(self._files, key=lambda d: self._files[d]["used"]):
+            total -= self._files[digest]["size"]
+            self._forget_file(digest)
+            if total <= self.max_bytes:
+                break
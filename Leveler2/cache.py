@@ -0,0 +1,121 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Least recently used cache bounded by the total size of its values."""
+
+    def __init__(self, budget, sizeof=len):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._sizeof = sizeof
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            value, _ = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        size = self._sizeof(value)
+        self.pop(key)
+        if size > self.budget:
+            return
+        self._data[key] = (value, size)
+        self.size += size
+        while self.size > self.budget:
+            _, (_, evicted) = self._data.popitem(last=False)
+            self.size -= evicted
+
+    def pop(self, key, default=None):
+        try:
+            value, size = self._data.pop(key)
+        except KeyError:
+            return default
+        self.size -= size
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+
+class SingleFlight:
+    """Share one in-flight call between concurrent callers using the same key."""
+
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def run(self, key, func, *args, **kwargs):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._finished(key, t))
+        # a cancelled caller must not cancel the call the others are waiting on
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+
+class CooldownTracker:
+    """Time of the last counted message of each member, per guild.
+
+    Times are given and persisted as wall clock timestamps but kept on the
+    monotonic clock, so cooldowns are not affected by system clock changes."""
+
+    def __init__(self):
+        # {guild_id: {member_id: monotonic time}}
+        self._guilds = {}
+
+    def __len__(self):
+        return sum(len(members) for members in self._guilds.values())
+
+    def last(self, guild_id, member_id):
+        """Monotonic time of the member's last counted message, None if unknown."""
+        return self._guilds.get(guild_id, {}).get(member_id)
+
+    def set(self, guild_id, member_id, timestamp):
+        """Record a message at wall clock `timestamp`, returns its monotonic time."""
+        last = time.monotonic() - max(time.time() - timestamp, 0.0)
+        self._guilds.setdefault(guild_id, {})[member_id] = last
+        return last
+
+    def forget(self, guild_id, member_id):
+        members = self._guilds.get(guild_id)
+        if members is not None:
+            members.pop(member_id, None)
+
+    def expire(self, guild_id, max_age):
+        """Drop the members of a guild idle for more than `max_age` seconds."""
+        members = self._guilds.get(guild_id)
+        if not members:
+            self._guilds.pop(guild_id, None)
+            return 0
+        oldest = time.monotonic() - max_age
+        idle = [member_id for member_id, last in members.items() if last < oldest]
+        for member_id in idle:
+            del members[member_id]
+        return len(idle)
+
+    def guild_ids(self):
+        return list(self._guilds)
@@ -0,0 +1,44 @@
+from io import BytesIO
+
+from PIL import Image, features
+
+# {output format: file extension}
+CARD_FORMATS = {
+    "png": "png",
+    "png-optimized": "png",
+    "png-quantized": "png",
+    "webp": "webp",
+    "jpeg": "jpg",
+}
+DEFAULT_QUALITY = 85
+# JPEG has no transparency, the rounded corners are filled with Discord's dark theme
+JPEG_BACKGROUND = (49, 51, 56)
+
+
+def available_formats():
+    """Output formats supported by the installed Pillow."""
+    return [f for f in CARD_FORMATS if f != "webp" or features.check("webp")]
+
+
+def card_filename(fmt):
+    return "profile." + CARD_FORMATS[fmt]
+
+
+def encode_card(img, fmt="png", quality=DEFAULT_QUALITY):
+    """Encode a rendered RGBA card, `quality` is used by webp and jpeg."""
+    temp = BytesIO()
+    if fmt == "png-optimized":
+        img.save(temp, format="PNG", optimize=True)
+    elif fmt == "png-quantized":
+        # fast octree is the only built-in quantizer that keeps the alpha channel
+        img.quantize(256, method=Image.Quantize.FASTOCTREE).save(temp, format="PNG", optimize=True)
+    elif fmt == "webp":
+        img.save(temp, format="WEBP", quality=quality, method=4)
+    elif fmt == "jpeg":
+        flat = Image.new("RGB", img.size, JPEG_BACKGROUND)
+        flat.paste(img, mask=img.getchannel("A"))
+        flat.save(temp, format="JPEG", quality=quality, optimize=True)
+    else:
+        img.save(temp, format="PNG")
+    temp.name = card_filename(fmt if fmt in CARD_FORMATS else "png")
+    return temp
@@ -0,0 +1,152 @@
+import random
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, level):
+        self.key = key
+        self.next = [None] * level
+        # width[i] is the number of nodes skipped by following next[i]
+        self.width = [0] * level
+
+
+class RankedSkipList:
+    """Sorted skip list with O(log n) insert, remove, rank and positional access.
+
+    Same layout as the Redis sorted set: every link knows how many nodes it
+    jumps over, so ranks are summed while walking down the levels."""
+
+    MAX_LEVEL = 32
+
+    def __init__(self):
+        self._head = _Node(None, self.MAX_LEVEL)
+        self._level = 1
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _random_level(self):
+        level = 1
+        while level < self.MAX_LEVEL and random.random() < 0.25:
+            level += 1
+        return level
+
+    def insert(self, key):
+        update = [None] * self.MAX_LEVEL
+        rank = [0] * self.MAX_LEVEL
+        node = self._head
+        for i in reversed(range(self._level)):
+            rank[i] = 0 if i == self._level - 1 else rank[i + 1]
+            while node.next[i] is not None and node.next[i].key < key:
+                rank[i] += node.width[i]
+                node = node.next[i]
+            update[i] = node
+        level = self._random_level()
+        if level > self._level:
+            for i in range(self._level, level):
+                rank[i] = 0
+                update[i] = self._head
+                self._head.width[i] = self._size
+            self._level = level
+        new = _Node(key, level)
+        for i in range(level):
+            new.next[i] = update[i].next[i]
+            update[i].next[i] = new
+            new.width[i] = update[i].width[i] - (rank[0] - rank[i])
+            update[i].width[i] = rank[0] - rank[i] + 1
+        for i in range(level, self._level):
+            update[i].width[i] += 1
+        self._size += 1
+
+    def remove(self, key):
+        update = [None] * self.MAX_LEVEL
+        node = self._head
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and node.next[i].key < key:
+                node = node.next[i]
+            update[i] = node
+        node = node.next[0]
+        if node is None or node.key != key:
+            raise KeyError(key)
+        for i in range(self._level):
+            if update[i].next[i] is node:
+                update[i].width[i] += node.width[i] - 1
+                update[i].next[i] = node.next[i]
+            else:
+                update[i].width[i] -= 1
+        while self._level > 1 and self._head.next[self._level - 1] is None:
+            self._level -= 1
+        self._size -= 1
+
+    def rank(self, key):
+        """1-based position of `key`, or None if it is not in the list."""
+        traversed = 0
+        node = self._head
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and node.next[i].key <= key:
+                traversed += node.width[i]
+                node = node.next[i]
+            if node is not self._head and node.key == key:
+                return traversed
+        return None
+
+    def _node_at(self, rank):
+        traversed = 0
+        node = self._head
+        for i in reversed(range(self._level)):
+            while node.next[i] is not None and traversed + node.width[i] <= rank:
+                traversed += node.width[i]
+                node = node.next[i]
+            if traversed == rank:
+                return node
+        return None
+
+    def slice(self, start, count):
+        """Yield up to `count` keys starting at the 1-based position `start`."""
+        if start < 1 or start > self._size:
+            return
+        node = self._node_at(start)
+        while node is not None and count > 0:
+            yield node.key
+            node = node.next[0]
+            count -= 1
+
+
+class LeaderboardIndex:
+    """Members of a guild ordered by experience, highest first."""
+
+    def __init__(self):
+        self._list = RankedSkipList()
+        self._exp = {}
+
+    def __len__(self):
+        return len(self._list)
+
+    def __contains__(self, member_id):
+        return member_id in self._exp
+
+    def update(self, member_id, exp):
+        old = self._exp.get(member_id)
+        if old == exp:
+            return
+        if old is not None:
+            self._list.remove((-old, member_id))
+        self._exp[member_id] = exp
+        self._list.insert((-exp, member_id))
+
+    def discard(self, member_id):
+        old = self._exp.pop(member_id, None)
+        if old is not None:
+            self._list.remove((-old, member_id))
+
+    def rank(self, member_id):
+        exp = self._exp.get(member_id)
+        if exp is None:
+            return None
+        return self._list.rank((-exp, member_id))
+
+    def top(self, count, start=1):
+        """List of (member_id, exp) for `count` members from rank `start`."""
+        return [(member_id, -exp) for exp, member_id in self._list.slice(start, count)]
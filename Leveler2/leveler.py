@@ -3,22 +3,62 @@ import re
 from redbot.core import checks, Config
 import discord
 from redbot.core import commands
-from redbot.core.data_manager import bundled_data_path
+from redbot.core.data_manager import bundled_data_path, cog_data_path
 from redbot.core.utils.menus import menu, DEFAULT_CONTROLS
 import asyncio
 import datetime
-from .userprofile import UserProfile
+import logging
+import time
+from .backgrounds import BackgroundCache, image_size
+from .cache import LRUCache, SingleFlight
+from .encoding import DEFAULT_QUALITY, available_formats, card_filename, encode_card
+from .renderpool import RenderPool, RenderPoolBusy
+from .stats import ListenerStats
+from . import transfer
+from .userprofile import PRUNE_BATCH_SIZE, UserProfile
 from PIL import Image, ImageDraw, ImageFont
 from math import floor, ceil
 import os
 import aiohttp
-from redbot.core.i18n import Translator, cog_i18n
+from redbot.core.i18n import Translator, cog_i18n, get_locale
 from io import BytesIO
-import functools
+import json
 import textwrap
 
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:
+    # python < 3.9, only the bot's local time is available
+    ZoneInfo = None
+
 
 _ = Translator("Leveler", __file__)
+log = logging.getLogger("red.andehcogs.leveler")
+
+# "<@id>" and "<@!id>", bots usually accept their mention as a prefix
+MENTION_PREFIX = re.compile(r"<@!?\d+>")
+
+
+def get_timezone(name):
+    """Return the tzinfo for `name`, None for the bot's local time."""
+    if name is None:
+        return None
+    if ZoneInfo is None:
+        raise ValueError(name)
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(name)
+
+
+def next_reset(now, reset_time, timezone=None):
+    """First datetime after `now` at `reset_time` (HH:MM) in `timezone`."""
+    hour, minute = (int(x) for x in reset_time.split(":"))
+    local = now.astimezone(get_timezone(timezone))
+    target = local.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if target <= local:
+        target += datetime.timedelta(days=1)
+    return target
 
 
 @cog_i18n(_)
@@ -29,9 +69,35 @@ class Leveler(commands.Cog):
         self.bot = bot
         self.profiles = UserProfile()
         self.loop = self.bot.loop.create_task(self.start())
-        self.restart = True
+        self.flush_loop = self.bot.loop.create_task(self.flush_ledger())
+        self.prune_loop = self.bot.loop.create_task(self.prune_departed())
+        # {guild_id: datetime} of the next daily reset
+        self.next_resets = {}
+        # {guild_id: (datetime, seconds, members)} of the last daily reset
+        self.last_resets = {}
+        # {guild_id: (datetime, pruned members)} of the last departed members cleanup
+        self.last_prunes = {}
+        # guilds where departed members were seen, cleaned up before the next full pass
+        self._prune_wanted = set()
+        self._prune_wake = asyncio.Event()
+        self._reschedule = asyncio.Event()
+        self._force_reset = False
+        # set on unload, the flush loop writes what is buffered once more and ends
+        self._unloading = asyncio.Event()
+        # rendered profile cards, keyed on everything visible on the card
+        self.card_cache = LRUCache(self.CARD_CACHE_BUDGET)
+        # {(user_id, avatar hash): avatar thumbnail}
+        self.avatar_cache = LRUCache(self.AVATAR_CACHE_BUDGET, sizeof=image_size)
+        self.load_card_assets()
         self.defaultrole = _("New")
         self._session = aiohttp.ClientSession()
+        self.backgrounds = BackgroundCache(cog_data_path(self) / "backgrounds", self._session)
+        self.render_pool = RenderPool()
+        # concurrent profile requests for the same member share one render
+        self.profile_flights = SingleFlight()
+        self.listener_stats = ListenerStats()
+        # {guild_id: (monotonic expiry, first characters of the prefixes, prefixes)}
+        self.command_prefixes = {}
 
     __version__ = "1.0.0"
     __author__ = "Malarne#1418"
@@ -54,63 +120,176 @@ class Leveler(commands.Cog):
         "tags": ["leveler", "pillow", "fun"],
     }
 
+    LEDGER_FLUSH_INTERVAL = 15
+    CARD_CACHE_BUDGET = 32 * 1024 * 1024
+    TRANSFER_CHUNK_SIZE = 1000
+    AVATAR_CACHE_BUDGET = 16 * 1024 * 1024
+    AVATAR_SIZE = 130
+    # prefix changes are seen right away, this only covers other ways to change them
+    PREFIX_CACHE_TTL = 300
+
     def cog_unload(self):
-        self.bot.remove_listener(self.listener)
+        self.bot.remove_listener(self.listener, "on_message")
+        self.bot.remove_listener(self.command_listener, "on_command_completion")
         asyncio.get_event_loop().create_task(self._session.close())
         self.loop.cancel()
+        self.prune_loop.cancel()
+        # not cancelled, a write cut short would be lost until the next load
+        self._unloading.set()
+        asyncio.get_event_loop().create_task(self.close_store())
+        self.render_pool.shutdown()
+
+    async def close_store(self):
+        try:
+            await self.flush_loop
+        finally:
+            await self.profiles.store.close()
+
+    async def flush_ledger(self):
+        """Periodically write buffered xp/today/lastmessage changes to Config"""
+        while not self._unloading.is_set():
+            try:
+                await asyncio.wait_for(self._unloading.wait(), timeout=self.LEDGER_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.profiles._expire_cooldowns()
+            try:
+                await self.profiles._flush_ledger()
+            except Exception:
+                # failed writes are requeued and retried on the next tick
+                log.exception("Could not write the buffered member changes")
+
+    # upper bound of a single sleep, guards against clock jumps and new guilds
+    RESET_MAX_SLEEP = 3600
+    # seconds between two passes looking for departed members in every guild
+    PRUNE_INTERVAL = 6 * 3600
+    # seconds between two batches of deleted members, keeps the store responsive
+    PRUNE_BATCH_DELAY = 1.0
+
+    async def configure_render_pool(self):
+        workers = await self.profiles.data.render_workers()
+        queue = await self.profiles.data.render_queue()
+        if (workers, queue) != (self.render_pool.workers, self.render_pool.max_queue):
+            old, self.render_pool = self.render_pool, RenderPool(workers, queue)
+            old.shutdown()
 
     async def start(self):
+        await self.profiles._load_store(cog_data_path(self))
+        await self.configure_render_pool()
         await self.bot.wait_until_ready()
+        for guild in self.bot.guilds:
+            await self.profiles._build_leaderboard(guild)
         while True:
-            if not self.restart:
-                guilds = self.bot.guilds
-                for i in guilds:
-                    profils = await self.profiles.data.all_members(i)
-                    for j in profils.keys():
-                        member = i.get_member(j)
-                        if member is None:
-                            await self._reset_member(i, j)
-                        else:
-                            await self.profiles.data.member(member).today.set(0)
-                self.restart = True
-            if datetime.datetime.now().strftime("%H:%M") in [
-                "05:00",
-                "05:01",
-                "05:02",
-                "05:03",
-                "05:04",
-                "05:05",
-            ]:
-                self.restart = False
-            await asyncio.sleep(30)
-
-    async def _reset_member(self, guild, memberid):
-        try:
-            base = self.profiles.data._get_base_group(self.profiles.data.MEMBER)
-            await base.clear_raw(str(guild.id), memberid)
-        except:
-            pass
+            if self._reschedule.is_set():
+                self._reschedule.clear()
+                self.next_resets.clear()
+            now = datetime.datetime.now(datetime.timezone.utc)
+            guild_ids = {guild.id for guild in self.bot.guilds}
+            for guild_id in [i for i in self.next_resets if i not in guild_ids]:
+                # left guilds are never reset, their past time would keep the delay at 0
+                del self.next_resets[guild_id]
+            for guild in self.bot.guilds:
+                if guild.id not in self.next_resets:
+                    settings = await self.profiles._get_settings(guild)
+                    try:
+                        when = next_reset(now, settings.reset_time, settings.timezone)
+                    except ValueError:
+                        when = next_reset(now, settings.reset_time)
+                    self.next_resets[guild.id] = when
+            force, self._force_reset = self._force_reset, False
+            due = [g for g in self.bot.guilds if force or self.next_resets[g.id] <= now]
+            for guild in due:
+                try:
+                    await self._daily_reset(guild)
+                except Exception:
+                    log.exception("Daily reset failed for guild %s", guild.id)
+                self.next_resets.pop(guild.id, None)
+            if due:
+                continue
+            delay = min(
+                [(t - now).total_seconds() for t in self.next_resets.values()]
+                + [self.RESET_MAX_SLEEP]
+            )
+            try:
+                await asyncio.wait_for(self._reschedule.wait(), timeout=max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _daily_reset(self, guild):
+        started = time.perf_counter()
+        member_ids = await self.profiles._reset_today(guild)
+        duration = time.perf_counter() - started
+        self.last_resets[guild.id] = (datetime.datetime.now(datetime.timezone.utc), duration, len(member_ids))
+        log.info(
+            "Daily reset of guild %s: %d members in %.3fs", guild.id, len(member_ids), duration
+        )
+
+    async def prune_departed(self):
+        """Remove the data of members who left, in the background"""
+        await self.bot.wait_until_ready()
+        full_pass = True
+        while True:
+            self._prune_wake.clear()
+            if full_pass:
+                guilds = list(self.bot.guilds)
+            else:
+                guilds = [g for g in self.bot.guilds if g.id in self._prune_wanted]
+            self._prune_wanted.clear()
+            for guild in guilds:
+                try:
+                    await self._prune_guild(guild)
+                except Exception:
+                    log.exception("Pruning departed members failed for guild %s", guild.id)
+            try:
+                await asyncio.wait_for(self._prune_wake.wait(), timeout=self.PRUNE_INTERVAL)
+                full_pass = False
+            except asyncio.TimeoutError:
+                full_pass = True
+
+    async def _prune_guild(self, guild):
+        if not guild.chunked:
+            # members are not all known yet, everyone missing would look departed
+            return
+        live = {member.id for member in guild.members}
+        departed = [i for i in await self.profiles._member_ids(guild) if i not in live]
+        pruned = 0
+        for i in range(0, len(departed), PRUNE_BATCH_SIZE):
+            # members may have come back since the comparison
+            batch = [m for m in departed[i:i + PRUNE_BATCH_SIZE] if guild.get_member(m) is None]
+            await self.profiles._prune_members(guild, batch)
+            pruned += len(batch)
+            await asyncio.sleep(self.PRUNE_BATCH_DELAY)
+        self.last_prunes[guild.id] = (datetime.datetime.now(datetime.timezone.utc), pruned)
+        if pruned:
+            log.info("Pruned %d departed members of guild %s", pruned, guild.id)
 
     @commands.command(hidden=True)
     @checks.is_owner()
     async def testreset(self, ctx):
-        self.restart = False
-        await ctx.send(_("Resets in 30 seconds max"), delete_after=30)
+        self._force_reset = True
+        self._reschedule.set()
+        await ctx.send(_("Resetting now"), delete_after=30)
 
     async def get_avatar(self, user):
-        try:
-            res = BytesIO()
-            await user.avatar.replace(format="png", size=1024).save(res, seek_begin=True)
-            return res
-        except:
-            async with self._session.get(user.avatar_url_as(format="png", size=1024)) as r:
-                img = await r.content.read()
-                return BytesIO(img)
+        """Avatar of `user` as a thumbnail ready to be pasted on the card"""
+        asset = user.display_avatar
+        key = (user.id, asset.key)
+        avatar = self.avatar_cache.get(key)
+        if avatar is None:
+            # smallest CDN size (powers of two) that covers the card avatar
+            size = 1 << (self.AVATAR_SIZE - 1).bit_length()
+            data = await asset.replace(format="png", size=size).read()
+            avatar = await self.bot.loop.run_in_executor(None, self.decode_avatar, data)
+            self.avatar_cache.set(key, avatar)
+        return avatar
+
+    def decode_avatar(self, data):
+        avatar = Image.open(BytesIO(data))
+        avatar.thumbnail((self.AVATAR_SIZE, self.AVATAR_SIZE))
+        return avatar
 
     async def get_background(self, url):
-        async with self._session.get(url) as f:
-            data = await f.read()
-            return Image.open(BytesIO(data))
+        return await self.backgrounds.get(url)
 
     def round_corner(self, radius):
         """Draw a round corner"""
@@ -135,59 +314,75 @@ class Leveler(commands.Cog):
         im.putalpha(alpha)
         return im
 
-    def make_full_profile(self, avatar_data, user, xp, nxp, lvl, minone, elo, ldb, desc, bg=None):
-        img = Image.new("RGBA", (340, 390), (17, 17, 17, 255))
-        if bg is not None:
-            bg_width, bg_height = bg.size
-            ratio = bg_height / 390
-            bg = bg.resize((int(bg_width / (ratio)), int(bg_height / ratio)))
-            if bg.size[0] < 340:
-                ratio = bg_width / 340
-                bg = bg.resize((int(bg_width / (ratio)), int(bg_height / ratio)))
-            bg = bg.convert("RGBA")
-            bg.putalpha(128)
-            offset = 0
-            if bg.size[0] >= 340:
-                offset = (int((-(bg.size[0] - 340) / 2)), 0)
-            if bg.size[0] < 340:
-                offset = (0, int((-(bg.size[1] - 390) / 2)))
-
-            img.paste(bg, offset, bg)
-        img = self.add_corners(img, 10)
-        draw = ImageDraw.Draw(img)
-        usercolor = (255, 255, 0)  # user.color.to_rgb()
+    def load_card_assets(self):
+        """Load fonts and build the parts of the profile card that never change"""
+        fontpath = str(bundled_data_path(self) / "cambria.ttc")
+        self.font1 = ImageFont.truetype(fontpath, 18)
+        self.font2 = ImageFont.truetype(fontpath, 22)
+        self.font3 = ImageFont.truetype(fontpath, 32)
+        self.card_mask = self.add_corners(Image.new("RGBA", (340, 390)), 10).getchannel("A")
+        holders = Image.new("RGBA", (340, 390), (0, 0, 0, 0))
         aviholder = self.add_corners(Image.new("RGBA", (140, 140), (255, 255, 255, 255)), 10)
         nameplate = self.add_corners(Image.new("RGBA", (180, 60), (0, 0, 0, 255)), 10)
         xptot = self.add_corners(Image.new("RGBA", (310, 20), (215, 215, 215, 255)), 10)
-        img.paste(aviholder, (10, 10), aviholder)
-        img.paste(nameplate, (155, 10), nameplate)
-        img.paste(xptot, (15, 340), xptot)
+        holders.paste(aviholder, (10, 10), aviholder)
+        holders.paste(nameplate, (155, 10), nameplate)
+        holders.paste(xptot, (15, 340), xptot)
+        self.card_holders = holders
+        # {(level, ranking, role) labels: layer}, one per locale
+        self.card_layers = {}
+        # {width: xp bar}
+        self.xp_bars = {}
 
-        fontpath = str(bundled_data_path(self) / "cambria.ttc")
+    def card_layer(self, labels):
+        """Static card foreground with the translated labels drawn on it"""
+        layer = self.card_layers.get(labels)
+        if layer is None:
+            layer = self.card_holders.copy()
+            draw = ImageDraw.Draw(layer)
+            for label, y in zip(labels, (180, 220, 260)):
+                draw.text((10, y), label, fill="white", font=self.font3)
+            self.card_layers[labels] = layer
+        return layer
 
-        font1 = ImageFont.truetype(fontpath, 18)
-        font2 = ImageFont.truetype(fontpath, 22)
-        font3 = ImageFont.truetype(fontpath, 32)
+    def xp_bar(self, width, color):
+        bar = self.xp_bars.get((width, color))
+        if bar is None:
+            bar = self.add_corners(Image.new("RGBA", (width, 20), color), 10)
+            self.xp_bars[(width, color)] = bar
+        return bar
 
-        avatar = Image.open(avatar_data)
-        avatar_size = 130, 130
-        avatar.thumbnail(avatar_size)
-        img.paste(avatar, (15, 15))
+    @staticmethod
+    def xp_percent(xp, nxp, minone):
         lxp = xp - minone
         lnxp = nxp - minone
-        lprc = ceil(lxp / (lnxp / 100))
-        b_offset = floor(lprc * 3.1)
-        xpbar = self.add_corners(Image.new("RGBA", (b_offset, 20), usercolor), 10)
-        img.paste(xpbar, (12, 340), xpbar)
+        return ceil(lxp / (lnxp / 100))
+
+    def make_full_profile(
+        self, avatar_data, user, xp, nxp, lvl, minone, elo, ldb, desc, bg=None, fmt="png", quality=DEFAULT_QUALITY
+    ):
+        img = Image.new("RGBA", (340, 390), (17, 17, 17, 255))
+        if bg is not None:
+            # already scaled to the card by the background cache
+            img.paste(bg, (0, 0), bg)
+        img.putalpha(self.card_mask)
+        usercolor = (255, 255, 0)  # user.color.to_rgb()
+        font1, font2, font3 = self.font1, self.font2, self.font3
 
         lvl_str = _("Level:")
         ldb_str = _("Ranking:")
         rank_str = _("Role:")
         prog_str = _("Progress:")
 
-        draw.text((10, 180), lvl_str, fill="white", font=font3)
-        draw.text((10, 220), ldb_str, fill="white", font=font3)
-        draw.text((10, 260), rank_str, fill="white", font=font3)
+        img.alpha_composite(self.card_layer((lvl_str, ldb_str, rank_str)))
+        draw = ImageDraw.Draw(img)
+
+        img.paste(avatar_data, (15, 15))
+        lprc = self.xp_percent(xp, nxp, minone)
+        b_offset = floor(lprc * 3.1)
+        xpbar = self.xp_bar(b_offset, usercolor)
+        img.paste(xpbar, (12, 340), xpbar)
+
         nick = user.display_name
         if font2.getlength(nick) > 150:
             nick = nick[:15] + "..."
@@ -211,30 +406,28 @@ class Leveler(commands.Cog):
             draw.text((margin, offset), f"{line}", fill=usercolor, font=font1)
             bbox = font1.getbbox(line)
             offset += bbox[3] - bbox[1]
-        temp = BytesIO()
-        img.save(temp, format="PNG")
-        temp.name = "profile.png"
-        return temp
+        return encode_card(img, fmt, quality)
 
     async def profile_data(self, user):
-        """Async get user profile data to pass to image creator"""
-        avatar = await self.get_avatar(user)
-        try:
-            bg = await self.get_background(await self.profiles._get_background(user))
-        except:
-            bg = None
-        default = await self.profiles.data.guild(user.guild).defaultrole()
+        """Async get user profile data to pass to image creator
+
+        Images are not fetched here, see `profile_images`."""
+        settings = await self.profiles._get_settings(user.guild)
+        default = settings.defaultrole
+        if not default:
+            default = self.defaultrole
         data = {
-            "avatar_data": avatar,
             "user": user,
             "xp": 0,
             "nxp": 100,
             "lvl": 1,
             "minone": 0,
-            "elo": default if default else _("New"),
+            "elo": default,
             "ldb": 0,
             "desc": "",
-            "bg": bg,
+            "bg": await self.profiles._get_background(user),
+            "fmt": settings.card_format,
+            "quality": settings.card_quality,
         }
         if not await self.profiles._is_registered(user):
             return data
@@ -248,24 +441,9 @@ class Leveler(commands.Cog):
                 data["minone"] = await self.profiles._get_xp_for_level(lvl - 1)
             else:
                 data["minone"] = 0
-            roles = await self.profiles._get_guild_roles(user.guild)
-            if len(roles) == 0:
-                default = await self.profiles.data.guild(user.guild).defaultrole()
-                data["elo"] = default if default else self.defaultrole
-            else:
-                if str(lvl) in roles.keys():
-                    data["elo"] = discord.utils.get(user.guild.roles, id=roles[str(lvl)]).name
-                else:
-                    tmp = 0
-                    for k, v in roles.items():
-                        if int(k) < lvl:
-                            tmp = int(v)
-                            pass
-                    if tmp == 0:
-                        data["elo"] = default if default else self.defaultrole
-                    else:
-                        rl = discord.utils.get(user.guild.roles, id=tmp)
-                        data["elo"] = rl.name
+            rl = await self.profiles._role_for_level(user.guild, lvl)
+            if rl is not None:
+                data["elo"] = rl.name
         return data
 
     @commands.command()
@@ -274,19 +452,100 @@ class Leveler(commands.Cog):
         """Show your leveler progress. Default to yourself."""
         if user is None:
             user = ctx.author
-        data = await self.profile_data(user)
-
-        task = functools.partial(self.make_full_profile, **data)
-        task = self.bot.loop.run_in_executor(None, task)
         try:
-            img = await asyncio.wait_for(task, timeout=60)
+            image, filename = await self.profile_flights.run(
+                (user.guild.id, user.id), self.render_profile, user
+            )
+        except RenderPoolBusy:
+            await ctx.send(_("Too many profiles are being drawn, try again in a moment."))
+            return
         except asyncio.TimeoutError:
+            await ctx.send(_("Drawing your profile took too long, try again later."))
+            return
+
+        await ctx.send(file=discord.File(BytesIO(image), filename=filename))
+
+    async def render_profile(self, user):
+        """(image bytes, file name) of the profile card of `user`, from the cache if possible
+
+        The image is encoded in the output format of the guild."""
+        data = await self.profile_data(user)
+        image = self.card_cache.get(self.profile_key(data))
+        if image is None:
+            # before downloading anything for a card that could not be rendered
+            self.render_pool.check()
+            bg_url = data["bg"]
+            await self.profile_images(data)
+            # the background digest is only known once it has been fetched
+            key = self.profile_key(dict(data, bg=bg_url))
+            task = self.render_pool.submit(self.make_full_profile, **data)
+            img = await asyncio.wait_for(task, timeout=60)
+            image = img.getvalue()
+            self.card_cache.set(key, image)
+        return image, card_filename(data["fmt"])
+
+    async def profile_images(self, data):
+        """Replace the background url of profile data by the downloaded images"""
+        user = data["user"]
+        data["avatar_data"] = await self.get_avatar(user)
+        if data["bg"] is None:
+            # no member background and no guild default
             return
+        try:
+            data["bg"] = await self.get_background(data["bg"])
+        except Exception:
+            # BackgroundError, network failures and broken images, drawn without a background
+            data["bg"] = None
 
-        img.seek(0)
-        await ctx.send(file=discord.File(img))
+    def profile_key(self, data):
+        """Everything that is visible on a rendered profile card"""
+        user = data["user"]
+        return (
+            user.guild.id,
+            user.id,
+            user.display_avatar.key,
+            data["bg"],
+            self.backgrounds.digest(data["bg"]),
+            self.xp_percent(data["xp"], data["nxp"], data["minone"]),
+            data["xp"],
+            data["nxp"],
+            data["lvl"],
+            data["ldb"],
+            data["elo"],
+            data["desc"],
+            user.display_name,
+            f"{user.name}#{user.discriminator}",
+            get_locale(),
+            data["fmt"],
+            data["quality"],
+        )
+
+    async def get_command_prefixes(self, message):
+        """First characters of the command prefixes of the message's guild, and the prefixes"""
+        now = time.monotonic()
+        cached = self.command_prefixes.get(message.guild.id)
+        if cached is None or cached[0] <= now:
+            prefixes = await self.bot.get_prefix(message)
+            if isinstance(prefixes, str):
+                prefixes = [prefixes]
+            prefixes = tuple(p for p in prefixes if p and not MENTION_PREFIX.fullmatch(p.strip()))
+            cached = (now + self.PREFIX_CACHE_TTL, frozenset(p[0] for p in prefixes), prefixes)
+            self.command_prefixes[message.guild.id] = cached
+        return cached[1], cached[2]
+
+    async def command_listener(self, ctx):
+        # "set prefix" changes every guild's prefixes, "set serverprefix" only one
+        if ctx.command.qualified_name in ("set prefix", "set serverprefix"):
+            self.command_prefixes.clear()
 
     async def listener(self, message):
+        timer = self.listener_stats.timer()
+        try:
+            await self._process_message(message, timer)
+        finally:
+            timer.finish()
+
+    async def _process_message(self, message, timer):
         if type(message.author) != discord.Member:
             # throws an error when webhooks talk, this fixes it
             return
@@ -294,52 +553,57 @@ class Leveler(commands.Cog):
             return
         if message.author.bot:
             return
-        if await self.profiles.data.guild(message.guild).whitelist():
-            if message.channel.id not in await self.profiles._get_guild_channels(
-                message.author.guild
-            ):
+        if not self.profiles.store_loaded:
+            return
+        settings = await self.profiles._get_settings(message.guild)
+        timer.mark("filters")
+        if settings.whitelist:
+            if message.channel.id not in settings.wlchannels:
                 return
-        elif await self.profiles.data.guild(message.guild).blacklist():
-            if message.channel.id in await self.profiles._get_guild_blchannels(
-                message.author.guild
-            ):
+        elif settings.blacklist:
+            if message.channel.id in settings.blchannels:
                 return
+        timer.mark("lists")
 
-        if not await self.profiles._is_registered(message.author):
-            if await self.profiles._get_auto_register(message.guild):
+        registered = await self.profiles._is_registered(message.author)
+        if not registered:
+            if settings.autoregister:
                 await self.profiles._register_user(message.author)
-                return
+            timer.mark("registration")
+            return
 
-        elif await self.profiles._is_registered(message.author):
+        else:
+            timer.mark("registration")
             if message.content:
-                if message.content[0] in await self.bot.get_prefix(message):
+                chars, prefixes = await self.get_command_prefixes(message)
+                # the first character rules most messages out, "lv!" must not skip "lol"
+                if message.content[0] in chars and message.content.startswith(prefixes):
                     return
-            timenow = datetime.datetime.now().timestamp()
-            lastmessage = await self.profiles._get_user_lastmessage(message.author)
-            cooldown = await self.profiles._get_cooldown(message.guild)
-            if timenow - lastmessage < cooldown:
-                # check if we've passed the cooldown
-                # return None if messages are sent too soon
+            timer.mark("prefix")
+            if not await self.profiles._cooldown_ready(message.author, settings.cooldown):
+                # messages sent too soon are dropped without touching the store
                 return
+            timer.mark("cooldown")
             mots = len(message.content.split(" "))
             if mots <= 10:
                 xp = 1
             elif mots > 10:
                 xp = 2
             oldlvl = await self.profiles._get_level(message.author)
-            await self.profiles._today_addone(message.author)
-            await self.profiles._give_exp(message.author, xp)
-            await self.profiles._set_user_lastmessage(message.author, timenow)
+            await self.profiles._increment(message.author, exp=xp, today=1)
+            await self.profiles._set_user_lastmessage(message.author, time.time())
+            timer.mark("xp")
             lvl = await self.profiles._get_level(message.author)
-            if (
-                lvl == oldlvl + 1
-                and await self.profiles.data.guild(message.guild).lvlup_announce()
-            ):
+            if lvl == oldlvl + 1 and settings.lvlup_announce:
                 await message.channel.send(
                     _("{} is now level {} !".format(message.author.mention, lvl))
                 )
+            timer.mark("announce")
             await self.profiles._check_exp(message.author)
-            await self.profiles._check_role_member(message.author)
+            timer.mark("level")
+            if lvl != oldlvl:
+                await self.profiles._check_role_member(message.author)
+            timer.mark("roles")
 
     @commands.command()
     @commands.guild_only()
@@ -353,26 +617,52 @@ class Leveler(commands.Cog):
             await ctx.send(_("You have been successfully registered !"))
             return
 
-    @commands.command()
-    @commands.guild_only()
-    async def toplevel(self, ctx):
-        """Show the server leaderboard !"""
-        ld = await self.profiles._get_leaderboard(ctx.guild)
-        emb = discord.Embed(title=_("Ranking"))
-        for i in range(len(ld)):
-            cur = ld[i]
+    async def _send_leaderboard(self, ctx, ld, title):
+        emb = discord.Embed(title=title)
+        for cur in ld:
             user = ctx.guild.get_member(cur["id"])
             if user is None:
-                await self._reset_member(ctx.guild, cur["id"])
+                # left the server, removed by prune_departed
+                self._prune_wanted.add(ctx.guild.id)
+                self._prune_wake.set()
             else:
                 txt = (
                     _("Level:")
                     + " {} | {} XP | {} ".format(cur["lvl"], cur["xp"], cur["today"])
                     + _("Messages Today!")
                 )
-                emb.add_field(name="{}".format(user.display_name), value=txt)
+                emb.add_field(name="#{} {}".format(cur["rank"], user.display_name), value=txt)
         await ctx.send(embed=emb)
 
+    @commands.group(invoke_without_command=True)
+    @commands.guild_only()
+    async def toplevel(self, ctx):
+        """Show the server leaderboard !"""
+        await ctx.invoke(self.toplevel_page, page=1)
+
+    @toplevel.command(name="page")
+    @commands.guild_only()
+    async def toplevel_page(self, ctx, page: int = 1):
+        """Show a page of the server leaderboard."""
+        pages = await self.profiles._get_leaderboard_pages(ctx.guild)
+        if page < 1 or page > pages:
+            await ctx.send(_("Page must be between 1 and {}.").format(pages))
+            return
+        ld = await self.profiles._get_leaderboard_page(ctx.guild, page)
+        await self._send_leaderboard(
+            ctx, ld, _("Ranking") + " ({}/{})".format(page, pages)
+        )
+
+    @toplevel.command(name="me")
+    @commands.guild_only()
+    async def toplevel_me(self, ctx):
+        """Show the members ranked around you."""
+        ld = await self.profiles._get_leaderboard_around(ctx.guild, ctx.author)
+        if not ld:
+            await ctx.send(_("You are not ranked yet !"))
+            return
+        await self._send_leaderboard(ctx, ld, _("Ranking"))
+
     @commands.group()
     @checks.mod_or_permissions(manage_messages=True)
     @commands.guild_only()
@@ -598,6 +888,246 @@ class Leveler(commands.Cog):
         await self.profiles._set_cooldown(ctx.guild, cooldown)
         await ctx.send(_("Cooldown is now: ") + str(cooldown))
 
+    @levelerset.command()
+    @checks.mod_or_permissions(manage_messages=True)
+    @commands.guild_only()
+    async def resettime(self, ctx, reset_time: str = None):
+        """Show or set the time of the daily reset, as HH:MM."""
+        settings = await self.profiles._get_settings(ctx.guild)
+        if reset_time is None:
+            msg = _("Daily reset at {} ({}).").format(
+                settings.reset_time, settings.timezone or _("bot local time")
+            )
+            if ctx.guild.id in self.last_resets:
+                when, duration, members = self.last_resets[ctx.guild.id]
+                msg += "\n" + _("Last reset took {:.2f}s for {} members.").format(
+                    duration, members
+                )
+            if ctx.guild.id in self.last_prunes:
+                when, pruned = self.last_prunes[ctx.guild.id]
+                msg += "\n" + _("Last cleanup removed {} departed members.").format(pruned)
+            await ctx.send(msg)
+            return
+        if not re.fullmatch(r"([01]?\d|2[0-3]):[0-5]\d", reset_time):
+            await ctx.send(_("Please give a time formatted as HH:MM !"))
+            return
+        await self.profiles._set_reset_time(ctx.guild, reset_time)
+        self._reschedule.set()
+        await ctx.send(_("Daily reset time is now: ") + reset_time)
+
+    @levelerset.command()
+    @checks.mod_or_permissions(manage_messages=True)
+    @commands.guild_only()
+    async def timezone(self, ctx, timezone: str = None):
+        """Set the timezone of the daily reset, e.g. Europe/Paris.
+
+        Leave empty to use the bot local time."""
+        try:
+            get_timezone(timezone)
+        except ValueError:
+            await ctx.send(_("Unknown timezone: ") + str(timezone))
+            return
+        await self.profiles._set_timezone(ctx.guild, timezone)
+        self._reschedule.set()
+        await ctx.send(_("Daily reset timezone is now: ") + (timezone or _("bot local time")))
+
+    @levelerset.command(name="export")
+    @checks.admin_or_permissions(manage_guild=True)
+    @commands.guild_only()
+    async def _export(self, ctx, fmt: str = "jsonl"):
+        """Export the members experience data of this server as jsonl or csv."""
+        fmt = fmt.lower()
+        if fmt not in transfer.FORMATS:
+            await ctx.send(_("Format must be jsonl or csv."))
+            return
+        folder = cog_data_path(self) / "exports"
+        folder.mkdir(exist_ok=True)
+        path = folder / transfer.export_filename(ctx.guild.id, fmt)
+        async with ctx.typing():
+            writer = transfer.RecordWriter(path, fmt)
+            try:
+                async for chunk in self.profiles._iter_members(ctx.guild, self.TRANSFER_CHUNK_SIZE):
+                    writer.write(chunk)
+                    await asyncio.sleep(0)
+            finally:
+                writer.close()
+        if path.stat().st_size > ctx.guild.filesize_limit:
+            await ctx.send(
+                _("Exported {} members, the file is too big to upload and was saved to {}").format(
+                    writer.count, path
+                )
+            )
+            return
+        await ctx.send(
+            _("Exported {} members.").format(writer.count),
+            file=discord.File(str(path), filename=path.name),
+        )
+
+    @levelerset.command(name="import")
+    @checks.admin_or_permissions(manage_guild=True)
+    @commands.guild_only()
+    async def _import(self, ctx):
+        """Import members experience data from an attached jsonl or csv export.
+
+        Files may be gzipped. Levels are recomputed from experience."""
+        if not ctx.message.attachments:
+            await ctx.send(_("Please attach a jsonl or csv file exported with levelerset export."))
+            return
+        attachment = ctx.message.attachments[0]
+        fmt, gzipped = transfer.detect_format(attachment.filename)
+        if fmt is None:
+            await ctx.send(_("Please attach a jsonl or csv file exported with levelerset export."))
+            return
+        folder = cog_data_path(self) / "exports"
+        folder.mkdir(exist_ok=True)
+        path = folder / f"import-{ctx.guild.id}-{attachment.id}"
+        async with ctx.typing():
+            try:
+                with open(path, "wb") as fp:
+                    async with self._session.get(attachment.url) as r:
+                        r.raise_for_status()
+                        async for chunk in r.content.iter_chunked(64 * 1024):
+                            fp.write(chunk)
+                chunks = transfer.read_records(path, fmt, gzipped, self.TRANSFER_CHUNK_SIZE)
+                count = await self.profiles._import_members(ctx.guild, chunks)
+            except (aiohttp.ClientError, OSError, ValueError, KeyError) as e:
+                await ctx.send(_("Import failed: ") + str(e))
+                return
+            finally:
+                if path.exists():
+                    os.remove(path)
+        await ctx.send(_("Imported {} members.").format(count))
+
+    @levelerset.command()
+    @checks.is_owner()
+    async def backend(self, ctx, backend: str = None):
+        """Show or change where member data is stored: config or sqlite.
+
+        Changing it copies every member's data to the new backend."""
+        if backend is None:
+            await ctx.send(_("Member data is stored in: ") + self.profiles.store.name)
+            return
+        backend = backend.lower()
+        if backend not in ("config", "sqlite"):
+            await ctx.send(_("Backend must be config or sqlite."))
+            return
+        if backend == self.profiles.store.name:
+            await ctx.send(_("Member data is already stored in: ") + backend)
+            return
+        async with ctx.typing():
+            await self.profiles._switch_store(backend, cog_data_path(self))
+        await ctx.send(_("Member data migrated to: ") + backend)
+
+    @levelerset.command()
+    @checks.mod_or_permissions(manage_messages=True)
+    @commands.guild_only()
+    async def cardformat(self, ctx, card_format: str = None, quality: int = None):
+        """Show or set the image format of profile cards, and the quality of webp and jpeg.
+
+        Formats: png, png-optimized, png-quantized, webp, jpeg. Quality goes from 1 to 100."""
+        settings = await self.profiles._get_settings(ctx.guild)
+        formats = available_formats()
+        if card_format is None:
+            await ctx.send(
+                _("Profile cards are sent as {} (quality {}).\nAvailable formats: {}").format(
+                    settings.card_format, settings.card_quality, ", ".join(formats)
+                )
+            )
+            return
+        card_format = card_format.lower()
+        if card_format not in formats:
+            await ctx.send(_("Format must be one of: ") + ", ".join(formats))
+            return
+        if quality is None:
+            quality = settings.card_quality
+        if not 1 <= quality <= 100:
+            await ctx.send(_("Quality must be between 1 and 100."))
+            return
+        await self.profiles._set_card_format(ctx.guild, card_format, quality)
+        await ctx.send(
+            _("Profile cards are now sent as {} (quality {}).").format(card_format, quality)
+        )
+
+    @levelerset.command()
+    @checks.is_owner()
+    async def renderpool(self, ctx, workers: int = None, queue: int = None):
+        """Show the profile render pool, or set its worker threads and queue size."""
+        if workers is None:
+            stats = self.render_pool.stats()
+            await ctx.send(
+                _(
+                    "{workers} workers, {pending} pending ({queue_depth}/{max_queue} queued)\n"
+                    "{rendered} rendered, {rejected} rejected\n"
+                    "wait avg {wait_avg:.3f}s max {wait_max:.3f}s\n"
+                    "render avg {render_avg:.3f}s max {render_max:.3f}s"
+                ).format(**stats)
+            )
+            return
+        if workers < 1 or (queue is not None and queue < 0):
+            await ctx.send(_("Workers must be at least 1 and queue size at least 0."))
+            return
+        await self.profiles.data.render_workers.set(workers)
+        if queue is not None:
+            await self.profiles.data.render_queue.set(queue)
+        await self.configure_render_pool()
+        await ctx.send(
+            _("Render pool now has {} workers and a queue of {}.").format(
+                self.render_pool.workers, self.render_pool.max_queue
+            )
+        )
+
+    def stats_snapshot(self):
+        snapshot = self.listener_stats.snapshot()
+        snapshot["settings_rebuilds"] = self.profiles.settings_rebuilds
+        snapshot["ledger_members"] = sum(len(m) for m in self.profiles._ledger.values())
+        for name, cache in (("card_cache", self.card_cache), ("avatar_cache", self.avatar_cache)):
+            snapshot[name] = {
+                "entries": len(cache),
+                "size": cache.size,
+                "hits": cache.hits,
+                "misses": cache.misses,
+            }
+        snapshot["render_pool"] = self.render_pool.stats()
+        return snapshot
+
+    @levelerset.command()
+    @checks.is_owner()
+    async def stats(self, ctx, action: str = None):
+        """Show message listener timings and storage operations.
+
+        Use `json` to get a full snapshot as a file, or `reset` to start over."""
+        if action == "reset":
+            self.listener_stats.reset()
+            await ctx.send(_("Leveler stats reset."))
+            return
+        snapshot = self.stats_snapshot()
+        if action == "json":
+            fp = BytesIO(json.dumps(snapshot, indent=2).encode("utf-8"))
+            await ctx.send(file=discord.File(fp, filename="leveler-stats.json"))
+            return
+        lines = ["{:<13}{:>8}{:>10}{:>10}{:>10}{:>10}".format(
+            "stage", "count", "avg ms", "p50 ms", "p99 ms", "max ms"
+        )]
+        for stage, h in snapshot["stages"].items():
+            lines.append("{:<13}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}".format(
+                stage, h["count"], h["mean"] * 1000, h["p50"] * 1000, h["p99"] * 1000, h["max"] * 1000
+            ))
+        ops = snapshot["ops_per_message"]
+        lines.append("")
+        lines.append("storage ops/message: avg {:.2f} max {}".format(ops["mean"], ops["max"]))
+        for kind, count in sorted(ops["by_kind"].items()):
+            lines.append("  {:<24}{:>8}".format(kind, count))
+        lines.append("settings rebuilds: {}".format(snapshot["settings_rebuilds"]))
+        lines.append("buffered members: {}".format(snapshot["ledger_members"]))
+        for name in ("card_cache", "avatar_cache"):
+            lines.append("{}: {entries} entries, {hits} hits, {misses} misses".format(
+                name, **snapshot[name]
+            ))
+        pool = snapshot["render_pool"]
+        lines.append("render pool: {rendered} rendered, {rejected} rejected, "
+                     "render avg {render_avg:.3f}s".format(**pool))
+        await ctx.send("```\n" + "\n".join(lines) + "\n```")
+
     @levelerset.command()
     @checks.is_owner()
     @commands.guild_only()
@@ -624,6 +1154,15 @@ class Leveler(commands.Cog):
             await ctx.send(_("That user is not registered."))
         await ctx.send(member.name + _("'s XP set to ") + str(xp))
 
+    @levelerset.command()
+    @checks.mod_or_permissions(manage_messages=True)
+    @commands.guild_only()
+    async def recompute(self, ctx):
+        """Recompute every member's level from their xp."""
+        async with ctx.typing():
+            changed = await self.profiles._recompute_levels(ctx.guild)
+        await ctx.send(_("Levels recomputed, {} members updated.").format(changed))
+
     @levelerset.command()
     @checks.mod_or_permissions(manage_messages=True)
     @commands.guild_only()
@@ -642,7 +1181,7 @@ class Leveler(commands.Cog):
     @commands.guild_only()
     async def default_role(self, ctx, *, name):
         """Allow you to rename default role for your guild."""
-        await self.profiles.data.guild(ctx.author.guild).defaultrole.set(name)
+        await self.profiles._set_defaultrole(ctx.author.guild, name)
         await ctx.send(_(f"Default role name set to {name}"))
 
     @levelerset.command()
@@ -651,7 +1190,7 @@ class Leveler(commands.Cog):
     async def announce(self, ctx, status: bool):
         """Toggle whether the bot will announce levelups.
         args are True/False."""
-        await self.profiles.data.guild(ctx.guild).lvlup_announce.set(status)
+        await self.profiles._set_lvlup_announce(ctx.guild, status)
         await ctx.send(
             _("Levelup announce is now {}.").format(_("enabled") if status else _("disabled"))
         )
@@ -0,0 +1,89 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RenderPoolBusy(Exception):
+    """Raised when a render is submitted while the queue is full."""
+
+
+class RenderPool:
+    """Dedicated threads for profile rendering, with a bounded queue.
+
+    At most `workers` renders run at once and `max_queue` more may wait;
+    anything past that is rejected right away with RenderPoolBusy."""
+
+    def __init__(self, workers=2, max_queue=8):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="leveler-render"
+        )
+        # submitted and not finished yet, running or queued
+        self.pending = 0
+        self.rendered = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.render_total = 0.0
+        self.render_max = 0.0
+
+    @property
+    def queue_depth(self):
+        return max(self.pending - self.workers, 0)
+
+    @property
+    def full(self):
+        return self.pending >= self.workers + self.max_queue
+
+    def check(self):
+        """Raise RenderPoolBusy, counted as a rejection, if the queue is full."""
+        if self.full:
+            self.rejected += 1
+            raise RenderPoolBusy()
+
+    async def submit(self, func, *args, **kwargs):
+        self.check()
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+
+        def run():
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                loop.call_soon_threadsafe(self._done, started - submitted, time.perf_counter() - started)
+
+        self.pending += 1
+        future = self._executor.submit(run)
+        # also called when a queued render is cancelled before it started, run never executes then
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(self._release))
+        return await asyncio.wrap_future(future)
+
+    def _release(self):
+        self.pending -= 1
+
+    def _done(self, wait, render):
+        self.rendered += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self.render_total += render
+        self.render_max = max(self.render_max, render)
+
+    def stats(self):
+        rendered = self.rendered or 1
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "pending": self.pending,
+            "queue_depth": self.queue_depth,
+            "rendered": self.rendered,
+            "rejected": self.rejected,
+            "wait_avg": self.wait_total / rendered,
+            "wait_max": self.wait_max,
+            "render_avg": self.render_total / rendered,
+            "render_max": self.render_max,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
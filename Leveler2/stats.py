@@ -0,0 +1,132 @@
+import contextvars
+import time
+from bisect import bisect_left
+from collections import Counter
+
+# Stages of Leveler.listener, in the order they run
+STAGES = (
+    "filters",
+    "lists",
+    "registration",
+    "prefix",
+    "cooldown",
+    "xp",
+    "announce",
+    "level",
+    "roles",
+    "total",
+)
+
+# storage operations done by the message being processed, see count_op
+_message_ops = contextvars.ContextVar("leveler_message_ops", default=None)
+# storage operations since the cog was loaded, by kind
+storage_ops = Counter()
+
+
+def count_op(kind, count=1):
+    """Record `count` storage operations (Config or database round trips)."""
+    storage_ops[kind] += count
+    ops = _message_ops.get()
+    if ops is not None:
+        ops[kind] += count
+
+
+class Histogram:
+    """Latency histogram with power of two buckets from 1µs to about 17s."""
+
+    BOUNDS = tuple(2 ** i / 1e6 for i in range(25))
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.buckets[bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the `q` (0-1) percentile."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+            "buckets": dict(zip([*self.BOUNDS, "inf"], self.buckets)),
+        }
+
+
+class StageTimer:
+    """Times the stages of one message, see ListenerStats.timer."""
+
+    def __init__(self, stats):
+        self._stats = stats
+        self._started = self._last = time.perf_counter()
+        self._ops = Counter()
+        self._token = _message_ops.set(self._ops)
+
+    def mark(self, stage):
+        """Record the time spent since the previous mark under `stage`."""
+        now = time.perf_counter()
+        self._stats.stages[stage].add(now - self._last)
+        self._last = now
+
+    def finish(self):
+        _message_ops.reset(self._token)
+        self._stats.stages["total"].add(time.perf_counter() - self._started)
+        self._stats.messages += 1
+        self._stats.ops_per_message[sum(self._ops.values())] += 1
+        self._stats.message_ops.update(self._ops)
+
+
+class ListenerStats:
+    """Per-stage timings and storage operation counts of the message listener."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.stages = {stage: Histogram() for stage in STAGES}
+        self.messages = 0
+        # {storage operations in one message: messages}
+        self.ops_per_message = Counter()
+        # storage operations done while processing messages, by kind
+        self.message_ops = Counter()
+        storage_ops.clear()
+
+    def timer(self):
+        return StageTimer(self)
+
+    def snapshot(self):
+        total_ops = sum(n * c for n, c in self.ops_per_message.items())
+        return {
+            "messages": self.messages,
+            "stages": {stage: h.snapshot() for stage, h in self.stages.items()},
+            "ops_per_message": {
+                "mean": total_ops / self.messages if self.messages else 0.0,
+                "max": max(self.ops_per_message, default=0),
+                "distribution": dict(sorted(self.ops_per_message.items())),
+                "by_kind": dict(self.message_ops),
+            },
+            "storage_ops": dict(storage_ops),
+        }
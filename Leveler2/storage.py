@@ -0,0 +1,336 @@
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from .stats import count_op
+
+
+class ConfigMemberStore:
+    """Member data kept in Red's Config, the default backend."""
+
+    name = "config"
+
+    def __init__(self, config, defaults):
+        self.config = config
+        self.defaults = defaults
+
+    def _guild(self, guild_id):
+        return self.config._get_base_group(self.config.MEMBER, str(guild_id))
+
+    async def get(self, guild_id, member_id):
+        count_op("config.get")
+        return await self.config.member_from_ids(guild_id, member_id).all()
+
+    async def get_field(self, guild_id, member_id, field):
+        count_op("config.get_field")
+        return await self.config.member_from_ids(guild_id, member_id).get_attr(field)()
+
+    async def set_field(self, guild_id, member_id, field, value):
+        count_op("config.set_field")
+        await self.config.member_from_ids(guild_id, member_id).get_attr(field).set(value)
+
+    async def write(self, guild_id, updates):
+        """Merge {member_id: {field: value}} into a guild's member data.
+
+        Config has no write spanning several members, each member is read and
+        written back whole, one write per member. A single guild write would
+        cost as much as the guild is large, whatever the number of updates."""
+        for member_id, fields in updates.items():
+            group = self.config.member_from_ids(guild_id, member_id)
+            count_op("config.get")
+            data = await group.all()
+            data.update(fields)
+            count_op("config.write")
+            await group.set(data)
+
+    async def replace(self, guild_id, members):
+        """Replace all member data of a guild with {member_id: data} in one write."""
+        count_op("config.replace")
+        await self._guild(guild_id).set({str(k): v for k, v in members.items()})
+
+    async def all(self, guild_id):
+        count_op("config.all")
+        raw = await self._guild(guild_id).all()
+        return {int(k): dict(self.defaults, **v) for k, v in raw.items()}
+
+    async def ranked(self, guild_id):
+        """(member_id, exp) of every member, highest exp first."""
+        datas = await self.all(guild_id)
+        return sorted(
+            ((k, v["exp"]) for k, v in datas.items()), key=lambda x: x[1], reverse=True
+        )
+
+    async def iter_members(self, guild_id, chunk_size):
+        """Yield lists of (member_id, data), at most `chunk_size` long."""
+        # Config has no partial reads, the guild is loaded once and sliced
+        items = list((await self.all(guild_id)).items())
+        for i in range(0, len(items), chunk_size):
+            yield items[i:i + chunk_size]
+
+    async def member_ids(self, guild_id):
+        count_op("config.member_ids")
+        return [int(k) for k in await self._guild(guild_id).all()]
+
+    async def guild_ids(self):
+        count_op("config.guild_ids")
+        raw = await self.config._get_base_group(self.config.MEMBER).all()
+        return [int(k) for k in raw]
+
+    async def reset_today(self, guild_id):
+        # read, then written back
+        count_op("config.reset_today", 2)
+        async with self._guild(guild_id)() as members:
+            for data in members.values():
+                if data.get("today"):
+                    data["today"] = 0
+            return [int(k) for k in members]
+
+    async def delete(self, guild_id, member_ids):
+        # read, then written back
+        count_op("config.delete", 2)
+        async with self._guild(guild_id)() as members:
+            for member_id in member_ids:
+                members.pop(str(member_id), None)
+
+    async def recompute_levels(self, guild_id, level_from_xp):
+        # read, then written back
+        count_op("config.recompute_levels", 2)
+        changed = 0
+        async with self._guild(guild_id)() as members:
+            for data in members.values():
+                lvl = level_from_xp(data.get("exp", self.defaults["exp"]))
+                if lvl != data.get("level", self.defaults["level"]):
+                    data["level"] = lvl
+                    changed += 1
+        return changed
+
+    async def close(self):
+        pass
+
+
+class SQLiteMemberStore:
+    """Member data in an SQLite database in WAL mode.
+
+    Members are indexed by (guild_id, exp) for ranked queries. Every query
+    runs on a single dedicated thread, which owns the connection."""
+
+    name = "sqlite"
+    FIELDS = ("exp", "level", "today", "lastmessage", "background", "description")
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS members (
+            guild_id INTEGER NOT NULL,
+            member_id INTEGER NOT NULL,
+            exp INTEGER NOT NULL DEFAULT 0,
+            level INTEGER NOT NULL DEFAULT 1,
+            today INTEGER NOT NULL DEFAULT 0,
+            lastmessage REAL NOT NULL DEFAULT 0.0,
+            background TEXT,
+            description TEXT NOT NULL DEFAULT '',
+            PRIMARY KEY (guild_id, member_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS members_exp ON members (guild_id, exp DESC, member_id)",
+    )
+
+    def __init__(self, path, defaults):
+        self.path = path
+        self.defaults = defaults
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="leveler-sqlite")
+        self._conn = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _connection(self):
+        if self._conn is None:
+            conn = sqlite3.connect(str(self.path))
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _select(self, where, params):
+        cols = ", ".join(("member_id",) + self.FIELDS)
+        return self._connection().execute(f"SELECT {cols} FROM members WHERE {where}", params)
+
+    async def get(self, guild_id, member_id):
+        count_op("sqlite.get")
+
+        def query():
+            row = self._select(
+                "guild_id = ? AND member_id = ?", (guild_id, member_id)
+            ).fetchone()
+            return dict(zip(self.FIELDS, row[1:])) if row else dict(self.defaults)
+
+        return await self._run(query)
+
+    async def get_field(self, guild_id, member_id, field):
+        return (await self.get(guild_id, member_id))[field]
+
+    async def set_field(self, guild_id, member_id, field, value):
+        await self.write(guild_id, {member_id: {field: value}})
+
+    def _upsert(self, conn, guild_id, updates):
+        # one executemany per distinct set of updated columns
+        groups = {}
+        for member_id, fields in updates.items():
+            names = tuple(sorted(fields))
+            groups.setdefault(names, []).append(
+                (guild_id, member_id) + tuple(fields[f] for f in names)
+            )
+        for names, rows in groups.items():
+            unknown = set(names) - set(self.FIELDS)
+            if unknown:
+                raise ValueError(f"Unknown member fields: {', '.join(unknown)}")
+            conn.executemany(
+                "INSERT INTO members (guild_id, member_id, {cols}) VALUES (?, ?, {marks}) "
+                "ON CONFLICT (guild_id, member_id) DO UPDATE SET {sets}".format(
+                    cols=", ".join(names),
+                    marks=", ".join("?" for _ in names),
+                    sets=", ".join(f"{n} = excluded.{n}" for n in names),
+                ),
+                rows,
+            )
+
+    async def write(self, guild_id, updates):
+        """Upsert {member_id: {field: value}} in a single transaction."""
+        if not updates:
+            return
+        count_op("sqlite.write")
+
+        def query():
+            conn = self._connection()
+            with conn:
+                self._upsert(conn, guild_id, updates)
+
+        await self._run(query)
+
+    async def replace(self, guild_id, members):
+        """Replace all member data of a guild with {member_id: data} in a single transaction."""
+        count_op("sqlite.replace")
+
+        def query():
+            conn = self._connection()
+            with conn:
+                conn.execute("DELETE FROM members WHERE guild_id = ?", (guild_id,))
+                self._upsert(conn, guild_id, members)
+
+        await self._run(query)
+
+    async def all(self, guild_id):
+        count_op("sqlite.all")
+
+        def query():
+            rows = self._select("guild_id = ?", (guild_id,))
+            return {row[0]: dict(zip(self.FIELDS, row[1:])) for row in rows}
+
+        return await self._run(query)
+
+    async def ranked(self, guild_id):
+        count_op("sqlite.ranked")
+
+        def query():
+            return self._connection().execute(
+                "SELECT member_id, exp FROM members WHERE guild_id = ? "
+                "ORDER BY exp DESC, member_id",
+                (guild_id,),
+            ).fetchall()
+
+        return await self._run(query)
+
+    async def iter_members(self, guild_id, chunk_size):
+        """Yield lists of (member_id, data), at most `chunk_size` long."""
+
+        def query(after):
+            rows = self._select(
+                "guild_id = ? AND member_id > ? ORDER BY member_id LIMIT ?",
+                (guild_id, after, chunk_size),
+            )
+            return [(row[0], dict(zip(self.FIELDS, row[1:]))) for row in rows]
+
+        after = -1
+        while True:
+            count_op("sqlite.iter_members")
+            chunk = await self._run(query, after)
+            if not chunk:
+                return
+            yield chunk
+            after = chunk[-1][0]
+
+    async def member_ids(self, guild_id):
+        count_op("sqlite.member_ids")
+
+        def query():
+            rows = self._connection().execute(
+                "SELECT member_id FROM members WHERE guild_id = ?", (guild_id,)
+            )
+            return [row[0] for row in rows]
+
+        return await self._run(query)
+
+    async def guild_ids(self):
+        count_op("sqlite.guild_ids")
+
+        def query():
+            rows = self._connection().execute("SELECT DISTINCT guild_id FROM members")
+            return [row[0] for row in rows]
+
+        return await self._run(query)
+
+    async def reset_today(self, guild_id):
+        count_op("sqlite.reset_today")
+
+        def query():
+            conn = self._connection()
+            with conn:
+                rows = conn.execute("SELECT member_id FROM members WHERE guild_id = ?", (guild_id,))
+                member_ids = [row[0] for row in rows]
+                conn.execute(
+                    "UPDATE members SET today = 0 WHERE guild_id = ? AND today != 0", (guild_id,)
+                )
+            return member_ids
+
+        return await self._run(query)
+
+    async def delete(self, guild_id, member_ids):
+        count_op("sqlite.delete")
+
+        def query():
+            conn = self._connection()
+            with conn:
+                conn.executemany(
+                    "DELETE FROM members WHERE guild_id = ? AND member_id = ?",
+                    [(guild_id, member_id) for member_id in member_ids],
+                )
+
+        await self._run(query)
+
+    async def recompute_levels(self, guild_id, level_from_xp):
+        count_op("sqlite.recompute_levels")
+
+        def query():
+            conn = self._connection()
+            conn.create_function("level_from_xp", 1, level_from_xp, deterministic=True)
+            with conn:
+                cursor = conn.execute(
+                    "UPDATE members SET level = level_from_xp(exp) "
+                    "WHERE guild_id = ? AND level != level_from_xp(exp)",
+                    (guild_id,),
+                )
+            return cursor.rowcount
+
+        return await self._run(query)
+
+    async def close(self):
+        def query():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+        await self._run(query)
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,83 @@
+import csv
+import gzip
+import json
+
+# Member fields carried by exports, level is recomputed from exp on import
+EXPORT_FIELDS = ("exp", "level", "today", "background", "description")
+FORMATS = ("jsonl", "csv")
+
+
+def export_filename(guild_id, fmt):
+    return f"leveler-{guild_id}.{fmt}.gz"
+
+
+def detect_format(filename):
+    """Return (format, gzipped) for an export file name, format is None if unknown."""
+    name = filename.lower()
+    gzipped = name.endswith(".gz")
+    if gzipped:
+        name = name[:-3]
+    for fmt in FORMATS:
+        if name.endswith("." + fmt):
+            return fmt, gzipped
+    if name.endswith(".json"):
+        return "jsonl", gzipped
+    return None, gzipped
+
+
+class RecordWriter:
+    """Write member records to a gzipped JSONL or CSV file."""
+
+    def __init__(self, path, fmt):
+        self.fmt = fmt
+        self.count = 0
+        self._fp = gzip.open(path, "wt", encoding="utf-8", newline="")
+        if fmt == "csv":
+            self._csv = csv.writer(self._fp)
+            self._csv.writerow(("member_id",) + EXPORT_FIELDS)
+
+    def write(self, records):
+        for member_id, data in records:
+            if self.fmt == "csv":
+                self._csv.writerow(
+                    [member_id]
+                    + ["" if data[f] is None else data[f] for f in EXPORT_FIELDS]
+                )
+            else:
+                record = {"member_id": member_id}
+                record.update((f, data[f]) for f in EXPORT_FIELDS)
+                self._fp.write(json.dumps(record) + "\n")
+        self.count += len(records)
+
+    def close(self):
+        self._fp.close()
+
+
+def _parse(record):
+    """Member record with the types the stores expect, without level."""
+    background = record.get("background") or None
+    return {
+        "member_id": int(record["member_id"]),
+        "exp": int(record.get("exp") or 0),
+        "today": int(record.get("today") or 0),
+        "background": background,
+        "description": record.get("description") or "",
+    }
+
+
+def read_records(path, fmt, gzipped, chunk_size):
+    """Yield lists of at most `chunk_size` parsed member records."""
+    opener = gzip.open if gzipped else open
+    with opener(path, "rt", encoding="utf-8", newline="") as fp:
+        if fmt == "csv":
+            rows = csv.DictReader(fp)
+        else:
+            rows = (json.loads(line) for line in fp if line.strip())
+        chunk = []
+        for row in rows:
+            chunk.append(_parse(row))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
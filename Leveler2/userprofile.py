@@ -1,6 +1,84 @@
 from redbot.core import Config
+from bisect import bisect_right
+from collections import namedtuple
+from math import isqrt
 import asyncio
 import discord
+import time
+
+from .cache import CooldownTracker
+from .leaderboard import LeaderboardIndex
+from .stats import count_op
+from .storage import ConfigMemberStore, SQLiteMemberStore
+
+
+# Member fields touched on every counted message; kept in the write-behind
+# ledger and flushed to the member store in batches.
+LEDGER_FIELDS = ("exp", "level", "today", "lastmessage")
+
+LEADERBOARD_PAGE_SIZE = 10
+
+# Departed members removed per storage write, see _prune_members
+PRUNE_BATCH_SIZE = 500
+
+# Number of locks serializing the updates of a member, see _member_lock
+LOCK_STRIPES = 64
+
+# Seconds without a counted message before a member's cooldown is dropped
+# from memory; it is read back from the store on their next message.
+COOLDOWN_IDLE = 600
+
+
+def xp_for_level(lvl):
+    """Experience needed to go from `lvl` to the next level."""
+    return 5 * ((lvl - 1) ** 2) + (50 * (lvl - 1)) + 100
+
+
+def level_from_xp(xp):
+    """Level reached with `xp` experience, inverse of xp_for_level."""
+    # xp_for_level(n + 1) <= xp  <=>  (n + 5) ** 2 <= xp / 5 + 5
+    return max(isqrt(max(xp // 5 + 5, 0)) - 3, 1)
+
+
+class RoleTable:
+    """Level roles of a guild, sorted by level for bisect lookups."""
+
+    __slots__ = ("levels", "role_ids")
+
+    def __init__(self, roles):
+        # very old configs stored the roles as a list
+        items = sorted((int(k), v) for k, v in roles.items()) if isinstance(roles, dict) else []
+        self.levels = tuple(level for level, _ in items)
+        self.role_ids = tuple(role_id for _, role_id in items)
+
+    def __len__(self):
+        return len(self.levels)
+
+    def role_id(self, level):
+        """Id of the role of the highest level at or below `level`, None if there is none."""
+        i = bisect_right(self.levels, level)
+        return self.role_ids[i - 1] if i else None
+
+
+# Immutable view of the guild settings read by the message listener.
+GuildSettings = namedtuple(
+    "GuildSettings",
+    [
+        "whitelist",
+        "blacklist",
+        "wlchannels",
+        "blchannels",
+        "autoregister",
+        "cooldown",
+        "lvlup_announce",
+        "defaultrole",
+        "reset_time",
+        "timezone",
+        "roles",
+        "card_format",
+        "card_quality",
+    ],
+)
 
 
 class UserProfile:
@@ -18,7 +96,11 @@ class UserProfile:
             "cooldown": 60.0,
             "whitelist": True,
             "blacklist": False,
-            "lvlup_announce": False
+            "lvlup_announce": False,
+            "reset_time": "05:00",
+            "timezone": None,
+            "card_format": "png",
+            "card_quality": 85
         }
         default_member = {
             "exp": 0,
@@ -28,78 +110,356 @@ class UserProfile:
             "background": None,
             "description": ""
         }
+        default_global = {
+            "render_workers": 2,
+            "render_queue": 8,
+            "backend": "config"
+        }
         self.data.register_member(**default_member)
         self.data.register_guild(**default_guild)
+        self.data.register_global(**default_global)
+        self.default_member = default_member
+        # where member data lives, see _load_store
+        self.store = ConfigMemberStore(self.data, default_member)
+        self.store_loaded = False
+        # {guild_id: {member_id: {field: value}}}, current values of LEDGER_FIELDS
+        self._ledger = {}
+        # {guild_id: {member_id: {field, ...}}}, fields not yet written to the store
+        self._dirty = {}
+        self._flush_lock = asyncio.Lock()
+        # striped by member, so different members are updated concurrently
+        self._member_locks = [asyncio.Lock() for _ in range(LOCK_STRIPES)]
+        # {guild_id: GuildSettings}, rebuilt by every setter below
+        self._settings = {}
+        self.settings_rebuilds = 0
+        # {guild_id: {member_id, ...}}, loaded once from the guild database list
+        self._registered = {}
+        # {guild_id: LeaderboardIndex}, kept in sync with every xp change
+        self._leaderboards = {}
+        # last counted message of recently active members, see _cooldown_ready
+        self._cooldowns = CooldownTracker()
+
+    def _make_store(self, backend, path):
+        if backend == SQLiteMemberStore.name:
+            return SQLiteMemberStore(path / "members.db", self.default_member)
+        return ConfigMemberStore(self.data, self.default_member)
+
+    async def _load_store(self, path):
+        """Open the configured member backend, `path` is the cog data folder."""
+        backend = await self.data.backend()
+        if backend != self.store.name:
+            self.store = self._make_store(backend, path)
+        self.store_loaded = True
+
+    async def _switch_store(self, backend, path):
+        """Copy all member data to `backend` and use it from now on."""
+        store = self._make_store(backend, path)
+        # every store write holds the flush lock, none can go to the old store after the copy
+        async with self._flush_lock:
+            await self._flush_pending()
+            try:
+                # rows left in the target by an earlier switch are replaced, or dropped
+                guild_ids = set(await self.store.guild_ids()) | set(await store.guild_ids())
+                for guild_id in guild_ids:
+                    await store.replace(guild_id, await self.store.all(guild_id))
+            except BaseException:
+                await store.close()
+                raise
+            old, self.store = self.store, store
+            await self.data.backend.set(backend)
+        await old.close()
+
+    async def _rebuild_settings(self, guild):
+        count_op("guild.settings")
+        data = await self.data.guild(guild).all()
+        settings = GuildSettings(
+            whitelist=data["whitelist"],
+            blacklist=data["blacklist"],
+            wlchannels=frozenset(data["wlchannels"]),
+            blchannels=frozenset(data["blchannels"]),
+            autoregister=data["autoregister"],
+            cooldown=data["cooldown"],
+            lvlup_announce=data["lvlup_announce"],
+            defaultrole=data["defaultrole"],
+            reset_time=data["reset_time"],
+            timezone=data["timezone"],
+            roles=RoleTable(data["roles"]),
+            card_format=data["card_format"],
+            card_quality=data["card_quality"],
+        )
+        self._settings[guild.id] = settings
+        self.settings_rebuilds += 1
+        return settings
+
+    async def _get_settings(self, guild):
+        settings = self._settings.get(guild.id)
+        if settings is None:
+            settings = await self._rebuild_settings(guild)
+        return settings
+
+    async def _ledger_entry(self, member):
+        entries = self._ledger.setdefault(member.guild.id, {})
+        entry = entries.get(member.id)
+        if entry is None:
+            data = await self.store.get(member.guild.id, member.id)
+            # another task may have loaded this member while we were waiting
+            entry = entries.setdefault(member.id, {k: data[k] for k in LEDGER_FIELDS})
+        return entry
+
+    def _ledger_update(self, member, **fields):
+        self._ledger[member.guild.id][member.id].update(fields)
+        dirty = self._dirty.setdefault(member.guild.id, {})
+        dirty.setdefault(member.id, set()).update(fields)
+        if "exp" in fields:
+            self._update_leaderboard(member.guild.id, member.id, fields["exp"])
+
+    def _member_lock(self, guild_id, member_id):
+        return self._member_locks[hash((guild_id, member_id)) % LOCK_STRIPES]
+
+    async def _increment(self, member, **deltas):
+        """Atomically add `deltas` to the ledger fields of `member`.
+
+        The level follows exp. Returns the new values of the changed fields."""
+        async with self._member_lock(member.guild.id, member.id):
+            entry = await self._ledger_entry(member)
+            values = {field: entry[field] + delta for field, delta in deltas.items()}
+            if "exp" in values:
+                values["level"] = level_from_xp(values["exp"])
+            self._ledger_update(member, **values)
+        return values
+
+    async def _ledger_get(self, member, field):
+        return await self._member_field(member.guild.id, member.id, field)
+
+    async def _member_field(self, guild_id, member_id, field):
+        entry = self._ledger.get(guild_id, {}).get(member_id)
+        if entry is not None:
+            return entry[field]
+        return await self.store.get_field(guild_id, member_id, field)
+
+    async def _ledger_set(self, member, field, value):
+        async with self._member_lock(member.guild.id, member.id):
+            if member.id in self._ledger.get(member.guild.id, {}):
+                self._ledger_update(member, **{field: value})
+            else:
+                await self._store_set(member.guild.id, member.id, field, value)
+                if field == "exp":
+                    self._update_leaderboard(member.guild.id, member.id, value)
+
+    async def _store_set(self, guild_id, member_id, field, value):
+        # under the flush lock, so a store switch cannot copy around this write
+        async with self._flush_lock:
+            await self.store.set_field(guild_id, member_id, field, value)
+
+    def _forget_member(self, guild_id, member_id):
+        self._cooldowns.forget(guild_id, member_id)
+        self._ledger.get(guild_id, {}).pop(member_id, None)
+        self._dirty.get(guild_id, {}).pop(member_id, None)
+        if guild_id in self._leaderboards:
+            self._leaderboards[guild_id].discard(member_id)
+
+    def _update_leaderboard(self, guild_id, member_id, exp):
+        if guild_id in self._leaderboards:
+            self._leaderboards[guild_id].update(member_id, exp)
+
+    async def _build_leaderboard(self, guild):
+        # hold the flush lock so no buffered xp is evicted while we read the store
+        async with self._flush_lock:
+            index = LeaderboardIndex()
+            for member_id, exp in await self.store.ranked(guild.id):
+                index.update(member_id, exp)
+            for member_id, entry in self._ledger.get(guild.id, {}).items():
+                index.update(member_id, entry["exp"])
+            self._leaderboards[guild.id] = index
+        return index
+
+    async def _get_leaderboard_index(self, guild):
+        index = self._leaderboards.get(guild.id)
+        if index is None:
+            index = await self._build_leaderboard(guild)
+        return index
+
+    async def _flush_ledger(self):
+        async with self._flush_lock:
+            await self._flush_pending()
+
+    async def _flush_pending(self):
+        dirty, self._dirty = self._dirty, {}
+        try:
+            for guild_id in list(dirty):
+                entries = self._ledger.get(guild_id, {})
+                updates = {
+                    member_id: {f: entries[member_id][f] for f in fields}
+                    for member_id, fields in dirty[guild_id].items()
+                    if member_id in entries
+                }
+                await self.store.write(guild_id, updates)
+                del dirty[guild_id]
+                # drop entries that did not change while we were writing,
+                # reads fall back to the store which is now up to date
+                still_dirty = self._dirty.get(guild_id, {})
+                for member_id in updates:
+                    if member_id not in still_dirty:
+                        entries.pop(member_id, None)
+        finally:
+            # guilds left over after an error or a cancellation are written next time
+            for guild_id, pending in dirty.items():
+                requeue = self._dirty.setdefault(guild_id, {})
+                for member_id, fields in pending.items():
+                    requeue.setdefault(member_id, set()).update(fields)
+
+    async def _iter_members(self, guild, chunk_size):
+        """Yield chunks of (member_id, data) of a guild, buffered changes included."""
+        await self._flush_ledger()
+        async for chunk in self.store.iter_members(guild.id, chunk_size):
+            yield chunk
+
+    async def _import_members(self, guild, chunks):
+        """Write chunks of member records, as read by transfer.read_records.
+
+        Levels are recomputed from exp and every imported member is registered.
+        Each chunk is a single transaction on SQLite, Config still writes each
+        member on its own. Returns the number of imported members."""
+        count = 0
+        new_ids = []
+        registered = await self._registered_ids(guild)
+        for chunk in chunks:
+            updates = {}
+            for record in chunk:
+                member_id = record.pop("member_id")
+                record["level"] = level_from_xp(record["exp"])
+                updates[member_id] = record
+            # locked per chunk, a flush in between must not write older values over these
+            async with self._flush_lock:
+                await self.store.write(guild.id, updates)
+                for member_id in updates:
+                    # imported values replace anything still buffered
+                    self._ledger.get(guild.id, {}).pop(member_id, None)
+                    self._dirty.get(guild.id, {}).pop(member_id, None)
+            for member_id, record in updates.items():
+                self._update_leaderboard(guild.id, member_id, record["exp"])
+                if member_id not in registered:
+                    registered.add(member_id)
+                    new_ids.append(member_id)
+            count += len(updates)
+            await asyncio.sleep(0)
+        if new_ids:
+            count_op("guild.database", 2)
+            async with self.data.guild(guild).database() as db:
+                db.extend(new_ids)
+        return count
 
     async def _set_guild_background(self, guild, bg):
         await self.data.guild(guild).defaultbg.set(bg)
 
     async def _give_exp(self, member, exp):
-        current = await self.data.member(member).exp()
-        await self.data.member(member).exp.set(current + exp)
-        await self._check_exp(member)
+        await self._increment(member, exp=exp)
 
     async def _set_exp(self, member, exp):
-        await self.data.member(member).exp.set(exp)
-        await self._check_exp(member)
+        async with self._member_lock(member.guild.id, member.id):
+            await self._ledger_entry(member)
+            self._ledger_update(member, exp=exp, level=level_from_xp(exp))
 
     async def _set_level(self, member, level):
-        await self.data.member(member).level.set(level)
+        await self._ledger_set(member, "level", level)
+
+    async def _registered_ids(self, guild):
+        ids = self._registered.get(guild.id)
+        if ids is None:
+            count_op("guild.database")
+            db = await self.data.guild(guild).database()
+            ids = self._registered.setdefault(guild.id, set(db or []))
+        return ids
 
     async def _is_registered(self, member):
-        async with self.data.guild(member.guild).database() as db:
-            return member.id in db
+        return member.id in await self._registered_ids(member.guild)
 
     async def _register_user(self, member):
-        data = await self.data.guild(member.guild).database()
-        if data is None:
-            await self.data.guild(member.guild).database.set([])
-        async with self.data.guild(member.guild).database() as db:
-            db.append(member.id)
-        await self.data.member(member).exp.set(0)
+        ids = await self._registered_ids(member.guild)
+        if member.id not in ids:
+            ids.add(member.id)
+            count_op("guild.database")
+            data = await self.data.guild(member.guild).database()
+            if data is None:
+                count_op("guild.database")
+                await self.data.guild(member.guild).database.set([])
+            # read, then written back
+            count_op("guild.database", 2)
+            async with self.data.guild(member.guild).database() as db:
+                db.append(member.id)
+        await self._ledger_set(member, "exp", 0)
 
     async def _set_user_lastmessage(self, member, lastmessage:float):
-        await self.data.member(member).lastmessage.set(lastmessage)
+        await self._ledger_entry(member)
+        self._ledger_update(member, lastmessage=lastmessage)
+        self._cooldowns.set(member.guild.id, member.id, lastmessage)
 
     async def _get_user_lastmessage(self, member):
-        return await self.data.member(member).lastmessage()
+        return await self._ledger_get(member, "lastmessage")
+
+    async def _cooldown_ready(self, member, cooldown):
+        """Whether `member` may earn xp again, the store is only read for
+        members that have not been active recently.
+
+        When it may, the message is recorded right away, so concurrent
+        messages of the same member cannot all pass."""
+        last = self._cooldowns.last(member.guild.id, member.id)
+        if last is None:
+            lastmessage = await self._get_user_lastmessage(member)
+            # another message may have been recorded during the read
+            last = self._cooldowns.last(member.guild.id, member.id)
+            if last is None:
+                last = self._cooldowns.set(member.guild.id, member.id, lastmessage)
+        if time.monotonic() - last < cooldown:
+            return False
+        self._cooldowns.set(member.guild.id, member.id, time.time())
+        return True
+
+    def _expire_cooldowns(self):
+        """Forget the cooldowns of members idle for longer than it matters."""
+        expired = 0
+        for guild_id in self._cooldowns.guild_ids():
+            settings = self._settings.get(guild_id)
+            cooldown = settings.cooldown if settings is not None else 0
+            expired += self._cooldowns.expire(guild_id, max(COOLDOWN_IDLE, cooldown))
+        return expired
     
-    async def _downgrade_level(self, member):
-        lvl = await self.data.member(member).level()
-        pastlvl = 5*((lvl-2)**2)+(50*(lvl-2)) +100
-        xp = await self.data.member(member).exp()
-        while xp < pastlvl and not lvl <= 1:
-            lvl -= 1
-            pastlvl = 5*((lvl-1)**2)+(50*(lvl-1)) +100
-        await self.data.member(member).level.set(lvl)
-
     async def _check_exp(self, member):
-        lvl = await self.data.member(member).level()
-        lvlup = 5*((lvl-1)**2)+(50*(lvl-1)) +100
-        xp = await self.data.member(member).exp()
-        if xp >= lvlup:
-            await self.data.member(member).level.set(lvl+1)
-            lvl += 1
-            lvlup = 5*((lvl-1)**2)+(50*(lvl-1)) +100
-            if xp >= lvlup:
-                await self._check_exp(member)
-        elif xp < lvlup and lvl > 1:
-            await self._downgrade_level(member)
+        entry = await self._ledger_entry(member)
+        lvl = level_from_xp(entry["exp"])
+        if lvl != entry["level"]:
+            self._ledger_update(member, level=lvl)
+
+    async def _recompute_levels(self, guild):
+        """Recompute every member level of a guild from its xp in a single write.
+
+        Returns the number of members whose level changed."""
+        async with self._flush_lock:
+            await self._flush_pending()
+            changed = await self.store.recompute_levels(guild.id, level_from_xp)
+        # members updated since the flush keep their buffered xp
+        for member_id, entry in self._ledger.get(guild.id, {}).items():
+            lvl = level_from_xp(entry["exp"])
+            if lvl != entry["level"]:
+                entry["level"] = lvl
+                self._dirty.setdefault(guild.id, {}).setdefault(member_id, set()).add("level")
+        return changed
+
+    async def _role_for_level(self, guild, lvl):
+        """Role of the highest configured level at or below `lvl`, None if there is none."""
+        role_id = (await self._get_settings(guild)).roles.role_id(lvl)
+        if role_id is None:
+            return None
+        return guild.get_role(role_id)
 
     async def _check_role_member(self, member):
-        roles = await self.data.guild(member.guild).roles()
-        lvl = await self.data.member(member).level()
-        for k,v in roles.items():
-            if lvl == int(k):
-                rl = discord.utils.get(member.guild.roles, id=v)
-                if rl in member.roles:
-                    return True
-                else:
-                    await member.add_roles(rl)
-                    return True
-            else:
-                pass
-        return False
+        """Give `member` the role of their level, only needed when it changes."""
+        rl = await self._role_for_level(member.guild, await self._get_level(member))
+        if rl is None:
+            return False
+        if rl not in member.roles:
+            await member.add_roles(rl)
+        return True
 
     async def _add_guild_role(self, guild, level, roleid):
         role = discord.utils.get(guild.roles, id=roleid)
@@ -110,6 +470,7 @@ class UserProfile:
             rl = {}
         rl.update({str(level): roleid})
         await self.data.guild(guild).roles.set(rl)
+        await self._rebuild_settings(guild)
 
     async def _remove_guild_role(self, guild, role):
         rolelist = await self.data.guild(guild).roles()
@@ -117,6 +478,7 @@ class UserProfile:
             if v == role.id:
                 del rolelist[k]
                 await self.data.guild(guild).roles.set(rolelist)
+                await self._rebuild_settings(guild)
                 return
 
     async def _get_guild_roles(self, guild):
@@ -125,10 +487,12 @@ class UserProfile:
     async def _add_guild_channel(self, guild, channel):
         async with self.data.guild(guild).wlchannels() as chanlist:
             chanlist.append(channel)
+        await self._rebuild_settings(guild)
 
     async def _remove_guild_channel(self, guild, channel):
         async with self.data.guild(guild).wlchannels() as chanlist:
             chanlist.remove(channel)
+        await self._rebuild_settings(guild)
 
     async def _get_guild_channels(self, guild):
         return await self.data.guild(guild).wlchannels()
@@ -136,98 +500,153 @@ class UserProfile:
     async def _add_guild_blacklist(self, guild, channel):
         async with self.data.guild(guild).blchannels() as chanlist:
             chanlist.append(channel)
+        await self._rebuild_settings(guild)
 
     async def _remove_guild_blacklist(self, guild, channel):
         async with self.data.guild(guild).blchannels() as chanlist:
             chanlist.remove(channel)
+        await self._rebuild_settings(guild)
 
     async def _get_guild_blchannels(self, guild):
         return await self.data.guild(guild).blchannels()
 
     async def _toggle_whitelist(self, guild):
         wl = await self.data.guild(guild).whitelist()
-        if wl:
-            await self.data.guild(guild).whitelist.set(False)
-            return False
-        else:
-            await self.data.guild(guild).whitelist.set(True)
-            return True
+        await self.data.guild(guild).whitelist.set(not wl)
+        await self._rebuild_settings(guild)
+        return not wl
 
     async def _toggle_blacklist(self, guild):
         bl = await self.data.guild(guild).blacklist()
-        if bl:
-            await self.data.guild(guild).blacklist.set(False)
-            return False
-        else:
-            await self.data.guild(guild).blacklist.set(True)
-            return True
+        await self.data.guild(guild).blacklist.set(not bl)
+        await self._rebuild_settings(guild)
+        return not bl
 
     async def _get_exp(self, member):
-        return await self.data.member(member).exp()
+        return await self._ledger_get(member, "exp")
 
     async def _get_level(self, member):
-        return await self.data.member(member).level()
+        return await self._ledger_get(member, "level")
 
     async def _get_xp_for_level(self, lvl):
-        return 5 * ((lvl - 1) ** 2) + (50 * (lvl - 1)) + 100
+        return xp_for_level(lvl)
 
     async def _get_level_exp(self, member):
-        lvl = await self.data.member(member).level()
+        lvl = await self._get_level(member)
         return await self._get_xp_for_level(lvl)
 
     async def _get_today(self, member):
-        return await self.data.member(member).today()
+        return await self._ledger_get(member, "today")
 
     async def _today_addone(self, member):
-        await self.data.member(member).today.set(await self._get_today(member) + 1)
+        await self._increment(member, today=1)
 
     async def _set_auto_register(self, guild, autoregister:bool):
         await self.data.guild(guild).autoregister.set(autoregister)
+        await self._rebuild_settings(guild)
 
     async def _get_auto_register(self, guild):
-        return await self.data.guild(guild).autoregister()
+        return (await self._get_settings(guild)).autoregister
 
     async def _set_cooldown(self, guild, cooldown:float):
         await self.data.guild(guild).cooldown.set(cooldown)
+        await self._rebuild_settings(guild)
 
     async def _get_cooldown(self, guild):
-        return await self.data.guild(guild).cooldown()
+        return (await self._get_settings(guild)).cooldown
+
+    async def _set_lvlup_announce(self, guild, status:bool):
+        await self.data.guild(guild).lvlup_announce.set(status)
+        await self._rebuild_settings(guild)
+
+    async def _set_defaultrole(self, guild, name):
+        await self.data.guild(guild).defaultrole.set(name)
+        await self._rebuild_settings(guild)
+
+    async def _set_reset_time(self, guild, reset_time:str):
+        await self.data.guild(guild).reset_time.set(reset_time)
+        await self._rebuild_settings(guild)
+
+    async def _set_timezone(self, guild, timezone):
+        await self.data.guild(guild).timezone.set(timezone)
+        await self._rebuild_settings(guild)
+
+    async def _set_card_format(self, guild, card_format, quality):
+        await self.data.guild(guild).card_format.set(card_format)
+        await self.data.guild(guild).card_quality.set(quality)
+        await self._rebuild_settings(guild)
+
+    async def _reset_today(self, guild):
+        """Set today to 0 for every member of a guild in one write.
+
+        Returns the ids of all members with stored data."""
+        # a concurrent flush could write back an old today value
+        async with self._flush_lock:
+            member_ids = await self.store.reset_today(guild.id)
+            for entry in self._ledger.get(guild.id, {}).values():
+                entry["today"] = 0
+        return member_ids
+
+    async def _member_ids(self, guild):
+        """Ids of every member with data, stored or still buffered."""
+        member_ids = set(await self.store.member_ids(guild.id))
+        member_ids.update(self._ledger.get(guild.id, {}))
+        return member_ids
+
+    async def _prune_members(self, guild, member_ids):
+        """Delete stored data of the given members, PRUNE_BATCH_SIZE per write."""
+        for i in range(0, len(member_ids), PRUNE_BATCH_SIZE):
+            batch = member_ids[i:i + PRUNE_BATCH_SIZE]
+            async with self._flush_lock:
+                await self.store.delete(guild.id, batch)
+                for member_id in batch:
+                    self._forget_member(guild.id, member_id)
+            await asyncio.sleep(0)
 
     async def _set_background(self, member, background):
-        await self.data.member(member).background.set(background)
+        await self._store_set(member.guild.id, member.id, "background", background)
 
     async def _get_background(self, member):
-        userbg = await self.data.member(member).background()
+        userbg = await self.store.get_field(member.guild.id, member.id, "background")
         if userbg is None:
             return await self.data.guild(member.guild).defaultbg()
         else:
             return userbg
 
     async def _set_description(self, member, description:str):
-        await self.data.member(member).description.set(description)
+        await self._store_set(member.guild.id, member.id, "description", description)
 
     async def _get_description(self, member):
-        return await self.data.member(member).description()
+        return await self.store.get_field(member.guild.id, member.id, "description")
 
     async def _get_leaderboard_pos(self, guild, member):
-        datas = await self.data.all_members(guild)
-        infos = sorted(datas, key=lambda x: datas[x]["exp"], reverse=True)
-        return (infos.index(member.id)+1)
+        index = await self._get_leaderboard_index(guild)
+        return index.rank(member.id)
 
-    async def _get_leaderboard(self, guild):
-        datas = await self.data.all_members(guild)
-        infos = sorted(datas, key=lambda x: datas[x]["exp"], reverse=True)
+    async def _get_leaderboard(self, guild, start=1, count=LEADERBOARD_PAGE_SIZE):
+        index = await self._get_leaderboard_index(guild)
         res = []
-        count = 1
-        for i in infos:
+        for rank, (member_id, exp) in enumerate(index.top(count, start), start):
             tmp = {}
-            tmp["id"] = i
-            cur = datas[i]
-            tmp["xp"] = cur["exp"]
-            tmp["lvl"] = cur["level"]
-            tmp["today"] = cur["today"]
+            tmp["id"] = member_id
+            tmp["rank"] = rank
+            tmp["xp"] = exp
+            tmp["lvl"] = await self._member_field(guild.id, member_id, "level")
+            tmp["today"] = await self._member_field(guild.id, member_id, "today")
             res.append(tmp)
-            count += 1
-            if count == 10:
-                break
         return res
+
+    async def _get_leaderboard_page(self, guild, page):
+        start = (page - 1) * LEADERBOARD_PAGE_SIZE + 1
+        return await self._get_leaderboard(guild, start)
+
+    async def _get_leaderboard_around(self, guild, member, radius=LEADERBOARD_PAGE_SIZE // 2):
+        pos = await self._get_leaderboard_pos(guild, member)
+        if pos is None:
+            return []
+        start = max(pos - radius, 1)
+        return await self._get_leaderboard(guild, start, pos - start + radius + 1)
+
+    async def _get_leaderboard_pages(self, guild):
+        index = await self._get_leaderboard_index(guild)
+        return max(-(-len(index) // LEADERBOARD_PAGE_SIZE), 1)
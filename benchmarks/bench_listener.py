@@ -0,0 +1,220 @@
+"""Offline benchmark of the Leveler message listener.
+
+Drives Leveler.listener with synthetic messages from simulated guilds and
+members, on top of the in-memory Config and Discord objects from fakes.py.
+Reports messages per second, latency percentiles and storage operations
+per message. Only the cog's own requirements (pillow, aiohttp) are needed.
+
+    python benchmarks/bench_listener.py --guilds 10 --members 500 --messages 50000
+"""
+import argparse
+import asyncio
+import json
+import random
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import fakes
+
+ROOT = Path(__file__).resolve().parent.parent
+WORDS = "the quick brown fox jumps over a lazy dog while leveling up all day long".split()
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def build_guilds(args, rng):
+    guilds = []
+    next_id = 1000
+    for g in range(args.guilds):
+        guild = fakes.Guild(next_id)
+        next_id += 1
+        for c in range(args.channels):
+            guild.channels.append(fakes.TextChannel(next_id, guild))
+            next_id += 1
+        for lvl in (5, 10, 20, 40):
+            guild.roles.append(fakes.Role(next_id, f"level {lvl}"))
+            next_id += 1
+        for m in range(args.members):
+            guild.add_member(fakes.Member(next_id, guild, bot=rng.random() < args.bots))
+            next_id += 1
+        guilds.append(guild)
+    return guilds
+
+
+async def setup_guild(cog, guild, args, rng):
+    """Write the guild settings and the already registered members."""
+    from Leveler2.userprofile import level_from_xp
+
+    config = cog.profiles.data.guild(guild)
+    channels = [c.id for c in guild.channels[: max(len(guild.channels) // 2, 1)]]
+    await config.whitelist.set(args.mode == "whitelist")
+    await config.blacklist.set(args.mode == "blacklist")
+    await config.wlchannels.set(channels if args.mode == "whitelist" else [])
+    await config.blchannels.set(channels if args.mode == "blacklist" else [])
+    await config.cooldown.set(args.cooldown)
+    await config.autoregister.set(True)
+    await config.lvlup_announce.set(True)
+    await config.roles.set({str(lvl): role.id for lvl, role in zip((5, 10, 20, 40), guild.roles)})
+    registered = [m for m in guild.members if rng.random() < args.registered]
+    await config.database.set([m.id for m in registered])
+    updates = {}
+    for member in registered:
+        exp = rng.randint(0, args.max_xp)
+        updates[member.id] = {"exp": exp, "level": level_from_xp(exp)}
+    await cog.profiles.store.write(guild.id, updates)
+
+
+def make_messages(guilds, args, rng):
+    members = [(g, g.members) for g in guilds]
+    for _ in range(args.messages):
+        guild, pool = rng.choice(members)
+        words = rng.randint(1, 25)
+        content = " ".join(rng.choice(WORDS) for _ in range(words))
+        if rng.random() < args.commands:
+            content = "!" + content
+        yield fakes.Message(rng.choice(pool), rng.choice(guild.channels), content)
+
+
+async def wait_until(predicate, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError("the cog did not start in time")
+        await asyncio.sleep(0.01)
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    from Leveler2 import setup
+
+    guilds = build_guilds(args, rng)
+    bot = fakes.Bot(guilds)
+    await setup(bot)
+    cog = bot.cog
+    if args.backend != "config":
+        await cog.profiles.data.backend.set(args.backend)
+    await wait_until(lambda: cog.profiles.store_loaded)
+    for guild in guilds:
+        await setup_guild(cog, guild, args, rng)
+    bot.ready.set()
+    await wait_until(lambda: len(cog.profiles._leaderboards) >= len(guilds))
+
+    messages = list(make_messages(guilds, args, rng))
+    listener = bot.listeners["on_message"][0]
+    cog.listener_stats.reset()
+    fakes.counters.reads = fakes.counters.writes = 0
+    fakes.counters.latency = args.latency / 1000
+    latencies = []
+
+    async def handle(message):
+        started = time.perf_counter()
+        await listener(message)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for i in range(0, len(messages), args.concurrency):
+        await asyncio.gather(*(handle(m) for m in messages[i:i + args.concurrency]))
+    elapsed = time.perf_counter() - started
+    listener_reads, listener_writes = fakes.counters.reads, fakes.counters.writes
+
+    flush_started = time.perf_counter()
+    await cog.profiles._flush_ledger()
+    flush_elapsed = time.perf_counter() - flush_started
+
+    snapshot = cog.stats_snapshot()
+    await fakes.unload(cog)
+    if any(bot.listeners.values()):
+        raise RuntimeError(f"listeners left after unload: {bot.listeners}")
+
+    count = len(messages)
+    return {
+        "params": vars(args),
+        "messages": count,
+        "seconds": elapsed,
+        "messages_per_second": count / elapsed if elapsed else 0.0,
+        "latency": {
+            "mean": sum(latencies) / count if count else 0.0,
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99),
+            "max": max(latencies, default=0.0),
+        },
+        "storage_ops_per_message": snapshot["ops_per_message"]["mean"],
+        "config_reads_per_message": listener_reads / count if count else 0.0,
+        "config_writes_per_message": listener_writes / count if count else 0.0,
+        "flush": {
+            "seconds": flush_elapsed,
+            "config_reads": fakes.counters.reads - listener_reads,
+            "config_writes": fakes.counters.writes - listener_writes,
+        },
+        "stats": snapshot,
+    }
+
+
+def report(result):
+    lat = result["latency"]
+    lines = [
+        "{messages} messages in {seconds:.3f}s: {messages_per_second:,.0f} msg/s".format(**result),
+        "latency ms: mean {:.3f}  p50 {:.3f}  p99 {:.3f}  max {:.3f}".format(
+            lat["mean"] * 1000, lat["p50"] * 1000, lat["p99"] * 1000, lat["max"] * 1000
+        ),
+        "storage ops/message: {:.3f}  (config reads {:.3f}, writes {:.3f})".format(
+            result["storage_ops_per_message"],
+            result["config_reads_per_message"],
+            result["config_writes_per_message"],
+        ),
+        "final flush: {seconds:.3f}s, {config_reads} reads, {config_writes} writes".format(
+            **result["flush"]
+        ),
+        "",
+        "{:<13}{:>9}{:>10}{:>10}".format("stage", "count", "avg us", "p99 us"),
+    ]
+    for stage, h in result["stats"]["stages"].items():
+        lines.append(
+            "{:<13}{:>9}{:>10.1f}{:>10.1f}".format(stage, h["count"], h["mean"] * 1e6, h["p99"] * 1e6)
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--guilds", type=int, default=5)
+    parser.add_argument("--members", type=int, default=200, help="members per guild")
+    parser.add_argument("--channels", type=int, default=4, help="text channels per guild")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument(
+        "--mode", choices=("whitelist", "blacklist", "open"), default="open",
+        help="channel filtering, half of the channels are listed",
+    )
+    parser.add_argument("--cooldown", type=float, default=0.0, help="seconds between counted messages")
+    parser.add_argument("--registered", type=float, default=0.9, help="share of members already registered")
+    parser.add_argument("--bots", type=float, default=0.02, help="share of members that are bots")
+    parser.add_argument("--commands", type=float, default=0.05, help="share of messages that are commands")
+    parser.add_argument("--max-xp", type=int, default=20000, help="highest starting xp")
+    parser.add_argument("--backend", choices=("config", "sqlite"), default="config")
+    parser.add_argument("--latency", type=float, default=0.0, help="ms added to every Config operation")
+    parser.add_argument("--concurrency", type=int, default=1, help="messages handled at once")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", metavar="PATH", help="also write the full results as JSON")
+    args = parser.parse_args(argv)
+
+    data_path = fakes.install()
+    sys.path.insert(0, str(ROOT))
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(data_path, ignore_errors=True)
+    print(report(result))
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(result, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""Benchmark of the profile card renderer, with a regression check against baselines.
+
+Covers Leveler.make_full_profile with no, small and huge backgrounds, short
+and long descriptions and every bundled locale, the one-off decoding and
+preparation of downloaded backgrounds, and the encoding of a card in each
+output format. Each case runs in its own process so
+its peak RSS is not skewed by the others. Measures wall time, CPU time, peak
+RSS and output size. Timings depend on the machine, so baselines are kept
+locally rather than in the repository.
+
+    python benchmarks/bench_render.py --save-baselines   # record the current numbers
+    python benchmarks/bench_render.py                    # compare, exits 1 on regressions
+"""
+import argparse
+import asyncio
+import gc
+import json
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+
+import fakes
+
+ROOT = Path(__file__).resolve().parent.parent
+BASELINES = Path(__file__).resolve().parent / "render_baselines.json"
+
+# name: (format, size) of the synthetic background sources
+BACKGROUNDS = {
+    "small": ("JPEG", (480, 270)),
+    "huge": ("JPEG", (6000, 4000)),
+    "huge-png": ("PNG", (4000, 4000)),
+}
+DESCRIPTIONS = {
+    "short": "Hello there !",
+    "long": " ".join(["Lorem ipsum dolor sit amet, consectetur adipiscing elit."] * 40),
+}
+METRICS = ("wall", "cpu", "peak_rss", "rss_growth", "bytes")
+# absolute differences never reported as regressions, in each metric's unit
+SLACK = {"wall": 0.0005, "cpu": 0.0005, "peak_rss": 2.0, "rss_growth": 2.0, "bytes": 256}
+
+
+def locales():
+    return fakes.locales(ROOT / "Leveler2" / "leveler.py")
+
+
+def all_cases():
+    from Leveler2.encoding import available_formats
+
+    cases = [f"prepare/{name}" for name in BACKGROUNDS]
+    cases += [f"encode/{fmt}" for fmt in available_formats()]
+    for bg in ("none", "small", "huge"):
+        for desc in DESCRIPTIONS:
+            for locale in locales():
+                cases.append(f"render/{bg}/{desc}/{locale}")
+    return cases
+
+
+def make_sources(folder):
+    """Write the background sources, and the card-sized layers prepared from them."""
+    from PIL import Image
+    from Leveler2.backgrounds import decode_background, prepare_background
+
+    for name, (fmt, size) in BACKGROUNDS.items():
+        noise = Image.effect_noise(size, 48)
+        gradient = Image.linear_gradient("L").resize(size)
+        im = Image.merge("RGB", (noise, gradient, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+        buf = BytesIO()
+        im.save(buf, format=fmt, quality=90)
+        (folder / f"{name}.src").write_bytes(buf.getvalue())
+        prepare_background(decode_background(buf.getvalue())).save(folder / f"{name}.png")
+
+
+def rss_mib(peak):
+    """Peak or current resident set size of this process in MiB."""
+    # ru_maxrss is inherited from the parent process on Linux, VmHWM is not
+    field = "VmHWM:" if peak else "VmRSS:"
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith(field):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return maxrss / 2 ** 20 if sys.platform == "darwin" else maxrss / 2 ** 10
+
+
+def measure(func, iterations):
+    for _ in range(2):
+        output = func()
+    gc.collect()
+    rss_before = rss_mib(peak=False)
+    walls, cpus = [], []
+    for _ in range(iterations):
+        wall, cpu = time.perf_counter(), time.process_time()
+        output = func()
+        cpus.append(time.process_time() - cpu)
+        walls.append(time.perf_counter() - wall)
+    peak = rss_mib(peak=True)
+    return {
+        "wall": statistics.median(walls),
+        "cpu": statistics.median(cpus),
+        "peak_rss": peak,
+        "rss_growth": max(peak - rss_before, 0.0),
+        "bytes": len(output) if isinstance(output, bytes) else 0,
+    }
+
+
+def card_kwargs(cog, user, sources, bg_name, desc):
+    from PIL import Image
+
+    bg = None
+    if bg_name != "none":
+        with Image.open(sources / f"{bg_name}.png") as im:
+            im.load()
+            bg = im
+    avatar = Image.linear_gradient("L").convert("RGBA").resize((cog.AVATAR_SIZE, cog.AVATAR_SIZE))
+    return dict(
+        avatar_data=avatar,
+        user=user,
+        xp=1234,
+        nxp=1455,
+        lvl=7,
+        minone=1000,
+        elo="Regular",
+        ldb=42,
+        desc=DESCRIPTIONS[desc],
+        bg=bg,
+    )
+
+
+async def run_case(case, sources, iterations, quality):
+    from PIL import Image
+    from Leveler2 import setup
+    from Leveler2.backgrounds import decode_background, prepare_background
+    from Leveler2.encoding import encode_card
+
+    guild = fakes.Guild(1)
+    user = fakes.Member(2, guild, name="Benchmark user")
+    bot = fakes.Bot([guild])
+    await setup(bot)
+    cog = bot.cog
+    try:
+        kind, *rest = case.split("/")
+        if kind == "prepare":
+            data = (sources / f"{rest[0]}.src").read_bytes()
+            return measure(lambda: prepare_background(decode_background(data)), iterations)
+        if kind == "encode":
+            # a drawn card: decoding the default PNG output gives it back
+            png = cog.make_full_profile(**card_kwargs(cog, user, sources, "small", "short"))
+            card = Image.open(png)
+            card.load()
+            return measure(lambda: encode_card(card, rest[0], quality).getvalue(), iterations)
+        bg_name, desc, locale = rest
+        fakes.set_locale(locale)
+        kwargs = card_kwargs(cog, user, sources, bg_name, desc)
+        return measure(lambda: cog.make_full_profile(**kwargs).getvalue(), iterations)
+    finally:
+        await fakes.unload(cog)
+
+
+def run_in_process(case, sources, iterations, quality):
+    proc = subprocess.run(
+        [sys.executable, __file__, "--run-case", case, "--sources", str(sources),
+         "--iterations", str(iterations), "--quality", str(quality)],
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode:
+        raise RuntimeError(f"{case} failed:\n{proc.stderr}")
+    return json.loads(proc.stdout.splitlines()[-1])
+
+
+def compare(results, baselines, tolerance):
+    """Lines of the comparison table, and the number of regressions."""
+    lines = ["{:<30}{:>10}{:>10}{:>10}{:>10}{:>10}".format(
+        "case", "wall ms", "cpu ms", "peak MiB", "grow MiB", "KiB"
+    )]
+    regressions = 0
+    for case, result in results.items():
+        base = baselines.get(case)
+        cells, flags = [], []
+        for metric in METRICS:
+            value = result[metric]
+            scale = 1000 if metric in ("wall", "cpu") else 1 / 1024 if metric == "bytes" else 1
+            cell = f"{value * scale:.1f}"
+            if base is not None and metric in base:
+                limit = base[metric] * (1 + tolerance) + SLACK[metric]
+                if value > limit:
+                    cell += "!"
+                    flags.append(f"{metric} {value / base[metric]:.2f}x" if base[metric] else metric)
+            cells.append(cell)
+        lines.append("{:<30}{:>10}{:>10}{:>10}{:>10}{:>10}".format(case, *cells))
+        if base is None:
+            lines.append("    no baseline")
+        elif flags:
+            regressions += 1
+            lines.append("    REGRESSED: " + ", ".join(flags))
+    return lines, regressions
+
+
+def encode_summary(results):
+    """Encode time against size for each output format, compared to plain png."""
+    encodes = {c.split("/")[1]: r for c, r in results.items() if c.startswith("encode/")}
+    if not encodes:
+        return []
+    png = encodes.get("png")
+    lines = ["", "{:<16}{:>10}{:>10}{:>10}".format("format", "ms", "KiB", "vs png")]
+    for fmt, result in encodes.items():
+        ratio = f"{result['bytes'] / png['bytes']:.0%}" if png and png["bytes"] else "-"
+        lines.append("{:<16}{:>10.2f}{:>10.1f}{:>10}".format(
+            fmt, result["wall"] * 1000, result["bytes"] / 1024, ratio
+        ))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--filter", default="", help="only run cases containing this text")
+    parser.add_argument("--baselines", type=Path, default=BASELINES)
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative increase")
+    parser.add_argument("--quality", type=int, default=85, help="webp and jpeg quality")
+    parser.add_argument("--save-baselines", action="store_true", help="store the results as the new baselines")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    parser.add_argument("--sources", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    data_path = fakes.install()
+    sys.path.insert(0, str(ROOT))
+    try:
+        if args.run_case:
+            result = asyncio.run(run_case(args.run_case, args.sources, args.iterations, args.quality))
+            print(json.dumps(result))
+            return 0
+        cases = [c for c in all_cases() if args.filter in c]
+        sources = Path(tempfile.mkdtemp(prefix="leveler-bench-src-"))
+        try:
+            make_sources(sources)
+            results = {}
+            for case in cases:
+                results[case] = run_in_process(case, sources, args.iterations, args.quality)
+                print(f"{case}: {results[case]['wall'] * 1000:.2f} ms", file=sys.stderr)
+        finally:
+            shutil.rmtree(sources, ignore_errors=True)
+    finally:
+        shutil.rmtree(data_path, ignore_errors=True)
+
+    baselines = {}
+    if args.baselines.exists():
+        baselines = json.loads(args.baselines.read_text())
+    lines, regressions = compare(results, baselines, args.tolerance)
+    print("\n".join(lines + encode_summary(results)))
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=2)
+    if args.save_baselines:
+        baselines.update(results)
+        args.baselines.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+        print(f"Baselines saved to {args.baselines}")
+        return 0
+    if regressions:
+        print(f"{regressions} case(s) regressed by more than {args.tolerance:.0%}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
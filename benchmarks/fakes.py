@@ -0,0 +1,458 @@
+"""In-memory stand-ins for Red and discord.py, enough to load the Leveler cog offline.
+
+Call install() before importing Leveler2. Nothing here opens a connection:
+Config lives in a dict and Discord objects are plain Python objects."""
+import ast
+import asyncio
+import copy
+import sys
+import tempfile
+import types
+from pathlib import Path
+
+# cog data folder handed out by cog_data_path, see install()
+DATA_PATH = None
+# locale returned by get_locale and used by Translator, see set_locale
+LOCALE = "en-US"
+
+
+def set_locale(locale):
+    global LOCALE
+    LOCALE = locale
+
+
+class ConfigCounters:
+    """Reads and writes done on every MemoryConfig, with optional latency."""
+
+    def __init__(self):
+        self.latency = 0.0
+        self.reads = 0
+        self.writes = 0
+
+    async def read(self):
+        self.reads += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def write(self):
+        self.writes += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+counters = ConfigCounters()
+
+
+class _Context:
+    """Result of calling a config value: awaitable, or usable with `async with`."""
+
+    def __init__(self, node):
+        self.node = node
+        self.value = None
+
+    def __await__(self):
+        return self.node.all().__await__()
+
+    async def __aenter__(self):
+        self.value = await self.node.all()
+        return self.value
+
+    async def __aexit__(self, *exc):
+        await self.node.set(self.value)
+
+
+class _Node:
+    def __init__(self, config, path):
+        self._config = config
+        self._path = path
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self.get_attr(name)
+
+    def get_attr(self, name):
+        return _Node(self._config, self._path + (name,))
+
+    def __call__(self):
+        return _Context(self)
+
+    async def all(self):
+        await counters.read()
+        return self._config._read(self._path)
+
+    async def set(self, value):
+        await counters.write()
+        self._config._write(self._path, copy.deepcopy(value))
+
+    async def clear(self):
+        await counters.write()
+        self._config._write(self._path, None)
+
+
+class MemoryConfig:
+    """Red Config kept in a dict, values are deep copied like the real drivers do."""
+
+    GLOBAL = "GLOBAL"
+    GUILD = "GUILD"
+    MEMBER = "MEMBER"
+    # number of identifiers before the registered defaults apply
+    PRIMARY_KEYS = {GLOBAL: 0, GUILD: 1, MEMBER: 2}
+
+    def __init__(self):
+        self.defaults = {self.GLOBAL: {}, self.GUILD: {}, self.MEMBER: {}}
+        self.data = {}
+
+    @classmethod
+    def get_conf(cls, cog_instance, identifier, force_registration=False, **kwargs):
+        return cls()
+
+    def register_global(self, **defaults):
+        self.defaults[self.GLOBAL].update(defaults)
+
+    def register_guild(self, **defaults):
+        self.defaults[self.GUILD].update(defaults)
+
+    def register_member(self, **defaults):
+        self.defaults[self.MEMBER].update(defaults)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return _Node(self, (self.GLOBAL, name))
+
+    def _get_base_group(self, category, *keys):
+        return _Node(self, (category,) + tuple(keys))
+
+    def guild(self, guild):
+        return _Node(self, (self.GUILD, str(guild.id)))
+
+    def member(self, member):
+        return self.member_from_ids(member.guild.id, member.id)
+
+    def member_from_ids(self, guild_id, member_id):
+        return _Node(self, (self.MEMBER, str(guild_id), str(member_id)))
+
+    def _default(self, path):
+        category, keys = path[0], path[1:]
+        primary = self.PRIMARY_KEYS[category]
+        if len(keys) < primary:
+            return {}
+        default = self.defaults[category]
+        for key in keys[primary:]:
+            if not isinstance(default, dict):
+                return None
+            default = default.get(key)
+        return default
+
+    def _read(self, path):
+        value = self.data
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                value = None
+                break
+            value = value[key]
+        default = self._default(path)
+        if value is None:
+            return copy.deepcopy(default)
+        if isinstance(value, dict) and isinstance(default, dict):
+            return copy.deepcopy({**default, **value})
+        return copy.deepcopy(value)
+
+    def _write(self, path, value):
+        parent = self.data
+        for key in path[:-1]:
+            parent = parent.setdefault(key, {})
+        if value is None:
+            parent.pop(path[-1], None)
+        else:
+            parent[path[-1]] = value
+
+
+# discord.py
+
+class Role:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+
+
+class Guild:
+    def __init__(self, id, name=None):
+        self.id = id
+        self.name = name or f"guild-{id}"
+        self._members = {}
+        self.chunked = True
+        self.roles = []
+        self.channels = []
+        self.filesize_limit = 8 * 1024 * 1024
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    def add_member(self, member):
+        self._members[member.id] = member
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+    def get_role(self, role_id):
+        return utils_get(self.roles, id=role_id)
+
+
+class Member:
+    def __init__(self, id, guild, name=None, bot=False):
+        self.id = id
+        self.guild = guild
+        self.name = self.display_name = name or f"member-{id}"
+        self.mention = f"<@{id}>"
+        self.discriminator = "0"
+        self.bot = bot
+        self.roles = []
+        self.display_avatar = None
+
+    async def add_roles(self, *roles, **kwargs):
+        self.roles.extend(roles)
+
+
+class TextChannel:
+    def __init__(self, id, guild, name=None):
+        self.id = id
+        self.guild = guild
+        self.name = name or f"channel-{id}"
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+
+
+class Message:
+    def __init__(self, author, channel, content):
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+
+
+class Embed:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+        self.fields = []
+
+    def add_field(self, **kwargs):
+        self.fields.append(kwargs)
+        return self
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self
+
+
+class File:
+    def __init__(self, fp, filename=None, **kwargs):
+        self.fp = fp
+        self.filename = filename
+
+
+def utils_get(iterable, **attrs):
+    for item in iterable:
+        if all(getattr(item, k, None) == v for k, v in attrs.items()):
+            return item
+    return None
+
+
+class Bot:
+    """The parts of Red the cog touches outside of commands."""
+
+    def __init__(self, guilds, prefixes=("!",)):
+        self.loop = asyncio.get_running_loop()
+        self.guilds = list(guilds)
+        self.prefixes = list(prefixes)
+        # {event name: [listeners]}
+        self.listeners = {}
+        self.ready = asyncio.Event()
+
+    async def get_prefix(self, message):
+        return self.prefixes
+
+    async def wait_until_ready(self):
+        await self.ready.wait()
+
+    def add_listener(self, func, name=None):
+        # like discord.py, the event defaults to the function name
+        self.listeners.setdefault(name or func.__name__, []).append(func)
+
+    def remove_listener(self, func, name=None):
+        listeners = self.listeners.get(name or func.__name__, [])
+        if func in listeners:
+            listeners.remove(func)
+
+    async def add_cog(self, cog):
+        self.cog = cog
+
+
+async def unload(cog):
+    """Unload the cog and wait for its background tasks, the store is closed after."""
+    cog.cog_unload()
+    tasks = asyncio.all_tasks() - {asyncio.current_task()}
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# redbot.core
+
+class _Command:
+    def __init__(self, func, **kwargs):
+        self.callback = func
+        self.kwargs = kwargs
+        self.commands = []
+
+    def command(self, **kwargs):
+        return _command_decorator(self.commands, **kwargs)
+
+    def group(self, **kwargs):
+        return _command_decorator(self.commands, **kwargs)
+
+
+def _command_decorator(registry=None, **kwargs):
+    def decorator(func):
+        command = _Command(func, **kwargs)
+        if registry is not None:
+            registry.append(command)
+        return command
+
+    return decorator
+
+
+def _check(*args, **kwargs):
+    return lambda func: func
+
+
+class Cog:
+    pass
+
+
+def _unquote(line):
+    return ast.literal_eval(line.strip())
+
+
+def read_po(path):
+    """{msgid: msgstr} of the translated messages of a gettext catalog."""
+    messages = {}
+    key = msgid = msgstr = None
+    with open(path, encoding="utf-8") as fp:
+        for line in list(fp) + [""]:
+            line = line.strip()
+            if line.startswith("msgid "):
+                if msgid and msgstr:
+                    messages[msgid] = msgstr
+                key, msgid, msgstr = "id", _unquote(line[6:]), ""
+            elif line.startswith("msgstr "):
+                key, msgstr = "str", _unquote(line[7:])
+            elif line.startswith('"') and key:
+                if key == "id":
+                    msgid += _unquote(line)
+                else:
+                    msgstr += _unquote(line)
+            elif not line:
+                key = None
+    if msgid and msgstr:
+        messages[msgid] = msgstr
+    return messages
+
+
+def locales(file):
+    """Locales with a catalog next to `file`, the cog module."""
+    folder = Path(file).parent / "locales"
+    return sorted(p.stem for p in folder.glob("*.po*") if p.stem != "messages")
+
+
+class Translator:
+    """Looks messages up in the catalog of the current LOCALE."""
+
+    def __init__(self, name, file):
+        self.folder = Path(file).parent / "locales"
+        self.catalogs = {}
+
+    def __call__(self, untranslated):
+        catalog = self.catalogs.get(LOCALE)
+        if catalog is None:
+            catalog = {}
+            for suffix in (".po", ".pot"):
+                path = self.folder / (LOCALE + suffix)
+                if path.exists():
+                    catalog = read_po(path)
+                    break
+            self.catalogs[LOCALE] = catalog
+        return catalog.get(untranslated, untranslated)
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def install(data_path=None):
+    """Register the fake `discord` and `redbot` modules."""
+    global DATA_PATH
+    DATA_PATH = Path(data_path or tempfile.mkdtemp(prefix="leveler-bench-"))
+
+    channel = _module("discord.channel", TextChannel=TextChannel)
+    utils = _module("discord.utils", get=utils_get)
+    _module(
+        "discord",
+        Member=Member,
+        Role=Role,
+        Guild=Guild,
+        TextChannel=TextChannel,
+        Message=Message,
+        Embed=Embed,
+        File=File,
+        channel=channel,
+        utils=utils,
+    )
+
+    checks = _module(
+        "redbot.core.checks",
+        is_owner=_check,
+        mod_or_permissions=_check,
+        admin_or_permissions=_check,
+    )
+    commands = _module(
+        "redbot.core.commands",
+        Cog=Cog,
+        command=_command_decorator,
+        group=_command_decorator,
+        guild_only=_check,
+    )
+    data_manager = _module(
+        "redbot.core.data_manager",
+        bundled_data_path=lambda cog: Path(sys.modules[type(cog).__module__].__file__).parent / "data",
+        cog_data_path=lambda cog=None, raw_name=None: DATA_PATH,
+    )
+    i18n = _module(
+        "redbot.core.i18n",
+        Translator=Translator,
+        cog_i18n=lambda translator: (lambda cls: cls),
+        get_locale=lambda: LOCALE,
+    )
+
+    async def menu(ctx, pages, controls, *args, **kwargs):
+        pass
+
+    menus = _module("redbot.core.utils.menus", menu=menu, DEFAULT_CONTROLS={})
+    utils = _module("redbot.core.utils", menus=menus)
+    core = _module(
+        "redbot.core",
+        Config=MemoryConfig,
+        checks=checks,
+        commands=commands,
+        data_manager=data_manager,
+        i18n=i18n,
+        utils=utils,
+    )
+    _module("redbot", core=core)
+    return DATA_PATH
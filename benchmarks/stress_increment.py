@@ -0,0 +1,125 @@
+"""Stress check of UserProfile._increment: no xp or message count may be lost.
+
+Many tasks add xp to a small set of members at once, while the ledger is
+flushed (and its clean entries evicted) and some members get their xp set
+outright. Config operations are given a latency so tasks interleave at every
+await. Then members that are not buffered are reset while their store write
+is held up, and incremented meanwhile: only the member locks keep the
+increment from loading the old xp and writing it back over the reset.
+The final stored totals must match what was added, exits 1 otherwise.
+
+    python benchmarks/stress_increment.py --members 20 --tasks 200 --increments 50
+    python benchmarks/stress_increment.py --without-locks   # must report lost increments
+"""
+import argparse
+import asyncio
+import contextlib
+import random
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import fakes
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+async def run(args):
+    from Leveler2.userprofile import UserProfile, level_from_xp
+
+    rng = random.Random(args.seed)
+    profiles = UserProfile()
+    if args.without_locks:
+        profiles._member_lock = lambda guild_id, member_id: contextlib.nullcontext()
+    guild = fakes.Guild(1)
+    members = [fakes.Member(100 + i, guild) for i in range(args.members)]
+    # members whose xp is reset to zero halfway, their expected totals restart then
+    resets = set(rng.sample(members, args.members // 4))
+    expected = {m.id: [0, 0] for m in members}
+    fakes.counters.latency = args.latency / 1000
+    stop = asyncio.Event()
+
+    async def worker():
+        for _ in range(args.increments):
+            member = rng.choice(members)
+            xp = rng.randint(1, 2)
+            await profiles._increment(member, exp=xp, today=1)
+            expected[member.id][0] += xp
+            expected[member.id][1] += 1
+            await asyncio.sleep(0)
+
+    async def flusher():
+        while not stop.is_set():
+            await profiles._flush_ledger()
+            await asyncio.sleep(args.flush_interval / 1000)
+
+    async def resetter():
+        await asyncio.sleep(args.latency * args.increments / 2000)
+        for member in resets:
+            await profiles._set_exp(member, 0)
+            # the increments from here on are counted on top of the new value
+            expected[member.id][0] = 0
+
+    flush_task = asyncio.ensure_future(flusher())
+    started = time.perf_counter()
+    await asyncio.gather(resetter(), *(worker() for _ in range(args.tasks)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await flush_task
+
+    # evicts every member, so the resets below write through to the store like registration
+    await profiles._flush_ledger()
+    for member in members:
+        # the reset holds the member lock while it waits for the flush lock
+        async with profiles._flush_lock:
+            reset = asyncio.ensure_future(profiles._ledger_set(member, "exp", 0))
+            await asyncio.sleep(0)
+            increment = asyncio.ensure_future(profiles._increment(member, exp=1, today=1))
+            await asyncio.sleep(args.latency / 1000 * 4)
+        await asyncio.gather(reset, increment)
+        expected[member.id][0] = 1
+        expected[member.id][1] += 1
+    await profiles._flush_ledger()
+
+    stored = await profiles.store.all(guild.id)
+    lost = 0
+    for member in members:
+        exp, today = expected[member.id]
+        data = stored.get(member.id, {"exp": 0, "today": 0, "level": 1})
+        if data["exp"] != exp or data["today"] != today or data["level"] != level_from_xp(exp):
+            lost += 1
+            print(
+                f"member {member.id}: exp {data['exp']} expected {exp}, "
+                f"today {data['today']} expected {today}, level {data['level']}"
+            )
+    total = args.tasks * args.increments
+    print(f"{total} increments from {args.tasks} tasks in {elapsed:.3f}s, {total / elapsed:,.0f}/s")
+    print("no increments lost" if not lost else f"{lost} of {len(members)} members lost increments")
+    return 1 if lost else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--members", type=int, default=20)
+    parser.add_argument("--tasks", type=int, default=200)
+    parser.add_argument("--increments", type=int, default=50, help="increments per task")
+    parser.add_argument("--latency", type=float, default=0.2, help="ms added to every Config operation")
+    parser.add_argument("--flush-interval", type=float, default=2.0, help="ms between ledger flushes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--without-locks", action="store_true",
+        help="replace the member locks by no-ops, increments must then be lost",
+    )
+    args = parser.parse_args(argv)
+
+    data_path = fakes.install()
+    sys.path.insert(0, str(ROOT))
+    try:
+        return asyncio.run(run(args))
+    finally:
+        shutil.rmtree(data_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())